@@ -0,0 +1,11 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class CreatedAtCursorPagination(CursorPagination):
+    """Newest first, continuing from the created_at of the last row seen."""
+
+    ordering = ('-created_at', '-id')
+    page_size = getattr(settings, 'WATERMARK_LIST_PAGE_SIZE', 20)
+    page_size_query_param = 'page_size'
+    max_page_size = 100
@@ -1,22 +1,136 @@
 from rest_framework import serializers
-from core.models import WatermarkTemplate, WatermarkedFile, WatermarkSettings
+from core.models import UploadSession, WatermarkTemplate, WatermarkedFile, WatermarkSettings
+from core.admission import InputTooLarge, check_admissible
+from core.preflight import UnsupportedFile, detect_file_type, preflight
+from core.preview import preview_max_pages
+from core.uploads import max_upload_size
 
 class WatermarkTemplateSerializer(serializers.ModelSerializer):
     class Meta:
         model = WatermarkTemplate
-        fields = ['id', 'name', 'type', 'text', 'image', 'created_at']
+        fields = ['id', 'name', 'type', 'text', 'image', 'output_format', 'quality', 'created_at']
         read_only_fields = ['user']
 
 class WatermarkedFileSerializer(serializers.ModelSerializer):
+    derivatives = serializers.SerializerMethodField()
+
     class Meta:
         model = WatermarkedFile
-        fields = ['id', 'original_file', 'watermarked_file', 'file_type', 
+        fields = ['id', 'original_file', 'watermarked_file', 'derivatives', 'file_type', 
                  'watermark_template', 'position_x', 'position_y', 
-                 'opacity', 'rotation', 'created_at']
-        read_only_fields = ['user', 'watermarked_file']
+                 'opacity', 'rotation', 'status', 'error', 'content_hash', 'created_at']
+        read_only_fields = ['user', 'watermarked_file', 'status', 'error', 'content_hash']
+
+    def get_derivatives(self, obj):
+        # Same URL form as the watermarked_file field
+        storage = obj.watermarked_file.storage
+        request = self.context.get('request')
+        derivatives = {}
+        for name, derivative in obj.derivatives.items():
+            url = storage.url(derivative['name'])
+            derivatives[name] = {
+                'url': request.build_absolute_uri(url) if request is not None else url,
+                'width': derivative['width'],
+                'height': derivative['height'],
+            }
+        return derivatives
+
+    def validate(self, attrs):
+        original_file = attrs.get('original_file')
+        if original_file:
+            try:
+                # Route by content rather than by the declared type
+                attrs['file_type'] = detect_file_type(original_file)
+                check_admissible(original_file)
+            except (UnsupportedFile, InputTooLarge) as exc:
+                raise serializers.ValidationError({'original_file': str(exc)})
+        return attrs
+
+class WatermarkedFileStatusSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = WatermarkedFile
+        fields = ['id', 'status', 'error', 'watermarked_file']
+        read_only_fields = fields
 
 class WatermarkSettingsSerializer(serializers.ModelSerializer):
     class Meta:
         model = WatermarkSettings
         fields = ['default_opacity', 'default_position_x', 
-                 'default_position_y', 'default_rotation']
+                 'default_position_y', 'default_rotation', 'output_format',
+                 'jpeg_quality', 'webp_quality', 'png_compress_level',
+                 'optimize', 'keep_metadata']
+
+class WatermarkParametersSerializer(serializers.Serializer):
+    watermark_template = serializers.PrimaryKeyRelatedField(queryset=WatermarkTemplate.objects.all())
+    position_x = serializers.IntegerField(default=0)
+    position_y = serializers.IntegerField(default=0)
+    opacity = serializers.FloatField(default=0.5, min_value=0, max_value=1)
+    rotation = serializers.IntegerField(default=0)
+
+    def validate_watermark_template(self, value):
+        if value.user_id != self.context['request'].user.id:
+            raise serializers.ValidationError('Unknown watermark template')
+        return value
+
+class QuickWatermarkSerializer(serializers.Serializer):
+    file = serializers.FileField()
+    watermark_text = serializers.CharField(required=False, allow_blank=True)
+    watermark_image = serializers.ImageField(required=False)
+    position_x = serializers.IntegerField(default=0)
+    position_y = serializers.IntegerField(default=0)
+    opacity = serializers.FloatField(default=0.5, min_value=0, max_value=1)
+    rotation = serializers.IntegerField(default=0)
+
+    def validate_file(self, value):
+        try:
+            preflight(value)
+        except UnsupportedFile as exc:
+            raise serializers.ValidationError(str(exc))
+        return value
+
+    def validate(self, attrs):
+        if not attrs.get('watermark_text') and not attrs.get('watermark_image'):
+            raise serializers.ValidationError('Either watermark text or image must be provided')
+        if attrs.get('watermark_text') and attrs.get('watermark_image'):
+            raise serializers.ValidationError('Please provide either text or image watermark, not both')
+        return attrs
+
+class BatchWatermarkSerializer(WatermarkParametersSerializer):
+    pass
+
+class WatermarkPreviewSerializer(WatermarkParametersSerializer):
+    source = serializers.PrimaryKeyRelatedField(queryset=WatermarkedFile.objects.all(), required=False)
+    pages = serializers.CharField(default='1', help_text='Comma separated, 1-based PDF page numbers')
+    max_size = serializers.IntegerField(required=False, min_value=16)
+
+    def validate_source(self, value):
+        if value.user_id != self.context['request'].user.id:
+            raise serializers.ValidationError('Unknown file')
+        return value
+
+    def validate_pages(self, value):
+        try:
+            pages = [int(page) - 1 for page in value.split(',') if page.strip()]
+        except ValueError:
+            raise serializers.ValidationError('Pages must be comma separated numbers')
+        if not pages or min(pages) < 0:
+            raise serializers.ValidationError('Page numbers start at 1')
+        if len(pages) > preview_max_pages():
+            raise serializers.ValidationError(f'At most {preview_max_pages()} pages per preview')
+        return pages
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'filename', 'size', 'offset', 'created_at']
+        read_only_fields = ['offset']
+
+    def validate_size(self, value):
+        if value < 0:
+            raise serializers.ValidationError('Size cannot be negative')
+        if value > max_upload_size():
+            raise serializers.ValidationError(f'Uploads are limited to {max_upload_size()} bytes')
+        return value
+
+class UploadFinalizeSerializer(WatermarkParametersSerializer):
+    pass
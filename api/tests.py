@@ -1,3 +1,329 @@
-from django.test import TestCase
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import PyPDF2
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.utils import timezone
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient, APITestCase
+
+from core.management.commands.bench_watermark import make_image, make_pdf
+from core import preview
+from core.admission import AdmissionBusy
+from core.models import UploadSession, WatermarkTemplate, WatermarkedFile
+from core.tests import MediaTestCase
+from core.uploads import _hashers, part_path
+
+
+class BatchWatermarkTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.template = WatermarkTemplate.objects.create(name='Text', type='TEXT', text='SAMPLE', user=cls.user)
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def test_zip_bomb_is_rejected_before_streaming(self):
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('bomb.png', bytes(10 * 1024 * 1024))
+
+        response = self.client.post(reverse('api:batch-watermark'), {
+            'files': [SimpleUploadedFile('batch.zip', output.getvalue())],
+            'watermark_template': self.template.pk,
+        }, format='multipart')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('compressed more than', response.json()['error'])
+
+
+class QuickWatermarkTests(MediaTestCase):
+    client_class = APIClient
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def post(self, name, data, **params):
+        return self.client.post(reverse('api:quick-watermark'), {
+            'file': SimpleUploadedFile(name, data), **params,
+        }, format='multipart')
+
+    def test_text_watermark_on_an_image(self):
+        response = self.post('photo.png', make_image(0.1, 'PNG'), watermark_text='QUICK')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['watermarked_file_url'].endswith('.png'))
+
+    def test_text_watermark_on_a_pdf(self):
+        response = self.post('doc.pdf', make_pdf(2), watermark_text='QUICK', opacity=0.3)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['watermarked_file_url'].endswith('.pdf'))
+
+    def test_routes_by_content_not_name(self):
+        response = self.post('doc.pdf', make_image(0.1, 'PNG'), watermark_text='QUICK')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['watermarked_file_url'].endswith('.png'))
+
+    def test_needs_exactly_one_watermark(self):
+        self.assertEqual(self.post('photo.png', make_image(0.1, 'PNG')).status_code, 400)
+
+
+class PreviewTests(MediaTestCase):
+    client_class = APIClient
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+        cache.clear()
+
+    def post(self, data, **params):
+        return self.client.post(reverse('api:preview'), {
+            'file': SimpleUploadedFile('doc.pdf', data),
+            'watermark_template': self.template.pk, **params,
+        }, format='multipart')
+
+    def page_texts(self, response):
+        self.assertEqual(response.status_code, 200)
+        reader = PyPDF2.PdfReader(io.BytesIO(response.content))
+        return [page.extract_text().splitlines()[0] for page in reader.pages]
+
+    def test_renders_the_requested_pages(self):
+        response = self.post(make_pdf(5), pages='4,2')
+        self.assertEqual(self.page_texts(response), ['Benchmark page 4', 'Benchmark page 2'])
+
+    def test_pages_past_the_end_are_skipped(self):
+        response = self.post(make_pdf(2), pages='2,3,40')
+        self.assertEqual(self.page_texts(response), ['Benchmark page 2'])
+
+    @override_settings(WATERMARK_PREVIEW_MAX_PAGES=2)
+    def test_pages_per_request_are_capped(self):
+        response = self.post(make_pdf(5), pages='1,2,3')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('pages', response.json())
+
+    def test_repeated_preview_is_served_from_the_cache(self):
+        data = make_pdf(3)
+        with mock.patch('core.preview.preview_pdf', wraps=preview.preview_pdf) as preview_pdf:
+            first = self.post(data, pages='3')
+            second = self.post(data, pages='3')
+            self.post(data, pages='1')
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(preview_pdf.call_count, 2)
+
+    @override_settings(WATERMARK_MEMORY_BUDGET=1024)
+    def test_inputs_over_the_memory_budget_are_rejected(self):
+        response = self.post(make_image(0.1, 'PNG'))
+        self.assertEqual(response.status_code, 413)
+
+    def test_renders_wait_for_admission(self):
+        with mock.patch('core.preview.admit_file', side_effect=AdmissionBusy('Busy')):
+            response = self.post(make_pdf(1))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '5')
+
+
+class WatermarkedFileUpdateTests(MediaTestCase):
+    client_class = APIClient
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def create(self):
+        response = self.client.post(reverse('api:file-list'), {
+            'original_file': SimpleUploadedFile('photo.png', make_image(0.1, 'PNG')),
+            'file_type': 'IMAGE',
+            'watermark_template': self.template.pk,
+        }, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        return WatermarkedFile.objects.get(pk=response.json()['id'])
+
+    def update(self, watermarked_file, **data):
+        response = self.client.patch(reverse('api:file-detail', args=[watermarked_file.pk]), data,
+                                     format='multipart')
+        self.assertEqual(response.status_code, 200)
+        watermarked_file.refresh_from_db()
+        return watermarked_file
+
+    def test_recipe_change_renders_a_new_output(self):
+        watermarked_file = self.create()
+        stale = watermarked_file.watermarked_file.read()
+        watermarked_file = self.update(watermarked_file, opacity=0.9)
+        self.assertEqual(watermarked_file.status, 'DONE')
+        self.assertNotEqual(watermarked_file.watermarked_file.read(), stale)
+
+    def test_recipe_change_is_queued_for_the_worker(self):
+        watermarked_file = self.create()
+        with self.settings(WATERMARK_BACKGROUND_JOBS=True):
+            watermarked_file = self.update(watermarked_file, rotation=30)
+        self.assertEqual(watermarked_file.status, 'PENDING')
+        self.assertFalse(watermarked_file.watermarked_file)
+
+    def test_unchanged_recipe_keeps_the_output(self):
+        watermarked_file = self.create()
+        output = watermarked_file.watermarked_file.name
+        watermarked_file = self.update(watermarked_file, opacity=watermarked_file.opacity)
+        self.assertEqual((watermarked_file.status, watermarked_file.watermarked_file.name), ('DONE', output))
+
+    def test_shared_output_is_kept_for_the_other_rows(self):
+        first, second = self.create(), self.create()
+        self.assertEqual(second.watermarked_file.name, first.watermarked_file.name)
+        self.update(first, position_x=40)
+        self.assertTrue(second.watermarked_file.storage.exists(second.watermarked_file.name))
+
+
+class CursorPaginationTests(MediaTestCase):
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        WatermarkedFile.objects.bulk_create([
+            WatermarkedFile(user=cls.user, watermark_template=cls.template, file_type='IMAGE',
+                            original_file=f'original_files/{number}.png')
+            for number in range(8)
+        ])
+        # Rows sharing a created_at straddle page boundaries
+        now = timezone.now()
+        pks = list(WatermarkedFile.objects.order_by('pk').values_list('pk', flat=True))
+        WatermarkedFile.objects.filter(pk__in=pks[1:6]).update(created_at=now)
+        for minutes, pk in enumerate(pks[:1] + pks[6:], 1):
+            WatermarkedFile.objects.filter(pk=pk).update(created_at=now - timedelta(minutes=minutes))
+        cls.expected = list(WatermarkedFile.objects.order_by('-created_at', '-pk').values_list('pk', flat=True))
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def get_page(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_next_and_previous_visit_every_row_once(self):
+        pages = [self.get_page(reverse('api:file-list') + '?page_size=3')]
+        while pages[-1]['next']:
+            pages.append(self.get_page(pages[-1]['next']))
+        self.assertEqual([len(page['results']) for page in pages], [3, 3, 2])
+        self.assertEqual([row['id'] for page in pages for row in page['results']], self.expected)
+
+        backwards = [pages[-1]]
+        while backwards[-1]['previous']:
+            backwards.append(self.get_page(backwards[-1]['previous']))
+        self.assertEqual([row['id'] for page in reversed(backwards) for row in page['results']], self.expected)
+
+    def test_listing_uses_a_fixed_number_of_queries(self):
+        # Only the page itself, with no query per row
+        for page_size in (2, 8):
+            with self.subTest(page_size=page_size), self.assertNumQueries(1):
+                self.get_page(reverse('api:file-list') + f'?page_size={page_size}')
+
+
+class ChunkedUploadTests(MediaTestCase):
+    client_class = APIClient
+
+    def setUp(self):
+        upload_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, upload_dir, ignore_errors=True)
+        settings_override = override_settings(WATERMARK_UPLOAD_DIR=upload_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client.force_authenticate(self.user)
+
+    def start(self, data):
+        response = self.client.post(reverse('api:upload-list'), {'filename': 'photo.png', 'size': len(data)})
+        self.assertEqual(response.status_code, 201)
+        return UploadSession.objects.get(pk=response.json()['id'])
+
+    def send(self, session, data, first, content_range=None, **extra):
+        if content_range is None:
+            content_range = f'bytes {first}-{first + len(data) - 1}/{session.size}'
+        return self.client.generic(
+            'PUT', reverse('api:upload-detail', args=[session.pk]), data,
+            content_type='application/octet-stream', HTTP_CONTENT_RANGE=content_range, **extra,
+        )
+
+    def finalize(self, session):
+        return self.client.post(reverse('api:upload-finalize', args=[session.pk]),
+                                {'watermark_template': self.template.pk})
+
+    @override_settings(WATERMARK_MEMORY_BUDGET=1024)
+    def test_finalize_rejects_inputs_over_the_memory_budget(self):
+        data = make_image(0.1, 'PNG')
+        session = self.start(data)
+        self.assertEqual(self.send(session, data, 0).status_code, 200)
+        path = part_path(session)
+        self.assertTrue(os.path.exists(path))
+
+        response = self.finalize(session)
+
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(UploadSession.objects.filter(pk=session.pk).exists())
+        self.assertFalse(WatermarkedFile.objects.exists())
+
+    def test_rejects_bad_content_ranges(self):
+        session = self.start(b'0123456789')
+        for content_range in ('', 'bytes 0-4', 'bytes=0-4/10', 'bytes 4-0/10', 'bytes 0-4/11', 'bytes 0-5/10'):
+            with self.subTest(content_range=content_range):
+                self.assertEqual(self.send(session, b'01234', 0, content_range).status_code, 400)
+        session.refresh_from_db()
+        self.assertEqual(session.offset, 0)
+
+    def test_rejects_chunks_past_the_end(self):
+        session = self.start(b'0123456789')
+        self.send(session, b'01234567', 0)
+        self.assertEqual(self.send(session, b'89abc', 8, 'bytes 8-12/10').status_code, 416)
+
+    def test_offset_mismatch_reports_the_current_offset(self):
+        session = self.start(b'0123456789')
+        self.assertEqual(self.send(session, b'01234', 0).status_code, 200)
+
+        response = self.send(session, b'01234', 0)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Upload-Offset'], '5')
+
+    def test_resumes_after_a_short_body(self):
+        data = make_image(0.1, 'PNG')
+        session = self.start(data)
+        half = len(data) // 2
+
+        # The client announced the whole file but the connection dropped halfway
+        response = self.send(session, data, 0, **{'wsgi.input': io.BytesIO(data[:half])})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Upload-Offset'], str(half))
+        self.assertEqual(self.client.get(reverse('api:upload-detail', args=[session.pk])).json()['offset'], half)
+        self.assertEqual(self.send(session, data[half:], half).status_code, 200)
+        self.assertEqual(self.finalize(session).status_code, 201)
+        with WatermarkedFile.objects.get().original_file.open('rb') as fh:
+            self.assertEqual(fh.read(), data)
+
+    def test_finalize_hashes_the_assembled_file(self):
+        data = make_image(0.1, 'PNG')
+        session = self.start(data)
+        self.send(session, data[:1000], 0)
+        # A chunk handled by another process has to re-hash the part file
+        _hashers.clear()
+        self.send(session, data[1000:], 1000)
+
+        response = self.finalize(session)
+
+        self.assertEqual(response.status_code, 201)
+        watermarked_file = WatermarkedFile.objects.get()
+        self.assertEqual(watermarked_file.content_hash, hashlib.sha256(data).hexdigest())
+        self.assertEqual(watermarked_file.status, 'DONE')
+
+    def test_finalize_needs_every_byte(self):
+        session = self.start(b'0123456789')
+        self.send(session, b'01234', 0)
+        response = self.finalize(session)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Upload-Offset'], '5')
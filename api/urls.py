@@ -11,7 +11,16 @@ urlpatterns = [
     # File URLs
     path('files/', views.WatermarkedFileList.as_view(), name='file-list'),
     path('files/<int:pk>/', views.WatermarkedFileDetail.as_view(), name='file-detail'),
+    path('files/<int:pk>/status/', views.WatermarkedFileStatus.as_view(), name='file-status'),
+    path('files/<int:pk>/result/', views.WatermarkedFileResult.as_view(), name='file-result'),
     path('files/quick-watermark/', views.QuickWatermarkView.as_view(), name='quick-watermark'),
+    path('files/batch/', views.BatchWatermarkView.as_view(), name='batch-watermark'),
+    path('previews/', views.WatermarkPreviewView.as_view(), name='preview'),
+    
+    # Chunked uploads
+    path('uploads/', views.UploadSessionList.as_view(), name='upload-list'),
+    path('uploads/<uuid:pk>/', views.UploadSessionDetail.as_view(), name='upload-detail'),
+    path('uploads/<uuid:pk>/finalize/', views.UploadSessionFinalize.as_view(), name='upload-finalize'),
     
     # Settings URLs
     path('settings/', views.WatermarkSettingsList.as_view(), name='settings-list'),
@@ -2,13 +2,29 @@ from rest_framework import generics, status, permissions
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser
-from PIL import Image
-import PyPDF2
-import io
-from PIL import Image, ImageDraw, ImageFont
-from core.models import WatermarkTemplate, WatermarkedFile, WatermarkSettings
+from django.db import transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+import re
+from core.admission import AdmissionError, InputTooLarge, check_admissible
+from core.batch import InvalidBatch, check_uploads, iter_uploads, stream_batch_zip, watermark_batch
+from core.downloads import serve_file
+from core.encoding import encoder_options, recipe_options
+from core.executors import stream_response
+from core.jobs import RECIPE_FIELDS, enqueue, rerender
+from core.metrics import stage
+from core.overlays import warm_template
+from core.preflight import UnsupportedFile, detect_file_type, preflight
+from core.preview import preview_max_size, render_preview
+from core.results import ensure_rendered
+from core.models import UploadSession, WatermarkTemplate, WatermarkedFile, WatermarkSettings
+from core.uploads import OffsetMismatch, complete_upload, discard_upload, write_chunk
+from core.views import process_image_watermark_quick, process_pdf_watermark_quick
+from .pagination import CreatedAtCursorPagination
 from .serializers import (WatermarkTemplateSerializer, WatermarkedFileSerializer, 
-                         WatermarkSettingsSerializer)
+                         WatermarkedFileStatusSerializer, WatermarkSettingsSerializer,
+                         BatchWatermarkSerializer, WatermarkPreviewSerializer,
+                         UploadSessionSerializer, UploadFinalizeSerializer, QuickWatermarkSerializer)
 
 
 
@@ -16,12 +32,13 @@ class WatermarkTemplateList(generics.ListCreateAPIView):
     serializer_class = WatermarkTemplateSerializer
     permission_classes = [permissions.IsAuthenticated]
     parser_classes = (MultiPartParser, FormParser)
+    pagination_class = CreatedAtCursorPagination
 
     def get_queryset(self):
         return WatermarkTemplate.objects.filter(user=self.request.user)
 
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+        warm_template(serializer.save(user=self.request.user))
 
 class WatermarkTemplateDetail(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = WatermarkTemplateSerializer
@@ -35,45 +52,136 @@ class WatermarkedFileList(generics.ListCreateAPIView):
     serializer_class = WatermarkedFileSerializer
     permission_classes = [permissions.IsAuthenticated]
     parser_classes = (MultiPartParser, FormParser)
+    pagination_class = CreatedAtCursorPagination
 
     def get_queryset(self):
-        return WatermarkedFile.objects.filter(user=self.request.user)
+        return WatermarkedFile.objects.filter(user=self.request.user).select_related('user', 'watermark_template')
 
     def perform_create(self, serializer):
-        instance = serializer.save(user=self.request.user)
-        if instance.file_type == 'PDF':
-            # Process PDF watermark
-            pdf_reader = PyPDF2.PdfReader(instance.file)
-            pdf_writer = PyPDF2.PdfWriter()
-            
-            for page in pdf_reader.pages:
-                page.merge_page(instance.watermark_template.template)
-                pdf_writer.add_page(page)
+        output_options = recipe_options(
+            serializer.validated_data['file_type'], serializer.validated_data.get('watermark_template'),
+            WatermarkSettings.objects.filter(user=self.request.user).first()
+        )
+        with stage('store'):
+            instance = serializer.save(user=self.request.user, status='PENDING', output_options=output_options)
+        enqueue(instance)
+
+class AdmissionErrorMixin:
+    """Answer core.admission errors with their 413/429/503 status."""
+
+    def handle_exception(self, exc):
+        if isinstance(exc, AdmissionError):
+            response = Response({'error': str(exc)}, status=exc.status_code)
+            if exc.retry_after:
+                response['Retry-After'] = str(exc.retry_after)
+            return response
+        return super().handle_exception(exc)
+
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+def offset_response(session, status_code=status.HTTP_200_OK):
+    response = Response(UploadSessionSerializer(session).data, status=status_code)
+    response['Upload-Offset'] = str(session.offset)
+    return response
+
+class UploadSessionList(generics.CreateAPIView):
+    """Start a chunked upload of ``size`` bytes."""
+    serializer_class = UploadSessionSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user)
+
+class UploadSessionDetail(APIView):
+    """Resume (GET), send a chunk (PUT with Content-Range) or abort (DELETE) an upload."""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, pk):
+        return offset_response(get_object_or_404(UploadSession, pk=pk, user=request.user))
+
+    def put(self, request, pk):
+        match = CONTENT_RANGE.match(request.META.get('HTTP_CONTENT_RANGE', ''))
+        if match is None:
+            return Response({'error': 'Content-Range: bytes <first>-<last>/<size> is required'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        first, last, total = (int(value) for value in match.groups())
+        length = last - first + 1
+        if length <= 0 or int(request.META.get('CONTENT_LENGTH') or 0) != length:
+            return Response({'error': 'Content-Length does not match Content-Range'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        
+        # The row lock serialises chunks sent to the same session
+        with transaction.atomic():
+            session = get_object_or_404(UploadSession.objects.select_for_update(), pk=pk, user=request.user)
+            if total != session.size:
+                return Response({'error': 'Content-Range size does not match the upload'},
+                              status=status.HTTP_400_BAD_REQUEST)
+            try:
+                # Read the raw body without a parser. Under WSGI this streams from the
+                # socket; under ASGI Django has already spooled the whole request body
+                # (to a temporary file past FILE_UPLOAD_MAX_MEMORY_SIZE), so clients
+                # should keep chunks small there
+                write_chunk(session, first, request.stream, length)
+            except OffsetMismatch:
+                return offset_response(session, status.HTTP_409_CONFLICT)
+            except ValueError as exc:
+                return Response({'error': str(exc)}, status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            session.save(update_fields=['offset', 'updated_at'])
+        return offset_response(session)
+
+    def delete(self, request, pk):
+        session = get_object_or_404(UploadSession, pk=pk, user=request.user)
+        discard_upload(session)
+        session.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+class UploadSessionFinalize(APIView):
+    """Turn a complete upload into a WatermarkedFile and queue it."""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, pk):
+        serializer = UploadFinalizeSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        user_settings = WatermarkSettings.objects.filter(user=request.user).first()
+        
+        with transaction.atomic():
+            session = get_object_or_404(UploadSession.objects.select_for_update(), pk=pk, user=request.user)
+            try:
+                upload = complete_upload(session)
+            except OffsetMismatch:
+                return offset_response(session, status.HTTP_409_CONFLICT)
+            try:
+                file_type = detect_file_type(upload)
+                check_admissible(upload)
+            except (UnsupportedFile, InputTooLarge) as exc:
+                upload.close()
+                # Every byte has arrived, so the upload can never become valid
+                discard_upload(session)
+                session.delete()
+                status_code = exc.status_code if isinstance(exc, InputTooLarge) else status.HTTP_400_BAD_REQUEST
+                return Response({'error': str(exc)}, status=status_code)
             
-            output = io.BytesIO()
-            pdf_writer.write(output)
-            instance.watermarked_file.save(f'watermarked_{instance.file.name}', output)
-        else:
-            # Process image watermark
-            with Image.open(instance.file) as img:
-                watermark = Image.open(instance.watermark_template.template)
-                
-                # Resize watermark to fit the image
-                watermark = watermark.resize((img.width // 2, img.height // 2))
-                
-                # Calculate position to place watermark
-                position = ((img.width - watermark.width) // 2,
-                          (img.height - watermark.height) // 2)
-                
-                # Create a new image with transparency
-                transparent = Image.new('RGBA', img.size, (0, 0, 0, 0))
-                transparent.paste(img, (0, 0))
-                transparent.paste(watermark, position, mask=watermark)
-                
-                # Save the watermarked image
-                output = io.BytesIO()
-                transparent.save(output, format='PNG')
-                instance.watermarked_file.save(f'watermarked_{instance.file.name}', output)
+            watermarked_file = WatermarkedFile(
+                user=request.user,
+                original_file=upload,
+                file_type=file_type,
+                watermark_template=params['watermark_template'],
+                position_x=params['position_x'],
+                position_y=params['position_y'],
+                opacity=params['opacity'],
+                rotation=params['rotation'],
+                output_options=recipe_options(file_type, params['watermark_template'], user_settings),
+                status='PENDING'
+            )
+            # The part file is moved into storage under its digest, not copied
+            with stage('store'), upload:
+                watermarked_file.save()
+            discard_upload(session)
+            session.delete()
+        
+        enqueue(watermarked_file)
+        return Response(WatermarkedFileSerializer(watermarked_file).data, status=status.HTTP_201_CREATED)
 
 class WatermarkedFileDetail(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = WatermarkedFileSerializer
@@ -83,78 +191,142 @@ class WatermarkedFileDetail(generics.RetrieveUpdateDestroyAPIView):
     def get_queryset(self):
         return WatermarkedFile.objects.filter(user=self.request.user)
 
-class QuickWatermarkView(APIView):
+    def perform_update(self, serializer):
+        instance = serializer.instance
+        changed = 'original_file' in serializer.validated_data or any(
+            field in serializer.validated_data and serializer.validated_data[field] != getattr(instance, field)
+            for field in RECIPE_FIELDS
+        )
+        # A new template or file changes the recipe's encoder options
+        output_options = recipe_options(
+            serializer.validated_data.get('file_type', instance.file_type),
+            serializer.validated_data.get('watermark_template', instance.watermark_template),
+            WatermarkSettings.objects.filter(user=self.request.user).first()
+        )
+        instance = serializer.save(output_options=output_options)
+        if changed:
+            rerender(instance)
+
+class WatermarkedFileStatus(generics.RetrieveAPIView):
+    serializer_class = WatermarkedFileStatusSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return WatermarkedFile.objects.filter(user=self.request.user)
+
+class WatermarkedFileResult(AdmissionErrorMixin, APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, pk):
+        watermarked_file = get_object_or_404(WatermarkedFile, pk=pk, user=request.user)
+        # Renders outputs kept only as a recipe, see core.results
+        ready = ensure_rendered(watermarked_file)
+        if watermarked_file.status == 'FAILED':
+            return Response({'status': watermarked_file.status, 'error': watermarked_file.error},
+                          status=status.HTTP_409_CONFLICT)
+        if not ready:
+            return Response({'status': watermarked_file.status}, status=status.HTTP_202_ACCEPTED)
+        
+        return serve_file(request, watermarked_file.watermarked_file, content_hash=watermarked_file.render_key)
+
+class BatchWatermarkView(APIView):
     permission_classes = [permissions.IsAuthenticated]
     parser_classes = (MultiPartParser, FormParser)
 
     def post(self, request):
-        file = request.FILES.get('file')
-        watermark_text = request.data.get('watermark_text')
-        watermark_image = request.FILES.get('watermark_image')
+        files = request.FILES.getlist('files')
+        if not files:
+            return Response({'error': 'No files provided'}, status=status.HTTP_400_BAD_REQUEST)
         
-        if not file:
-            return Response({'error': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = BatchWatermarkSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        try:
+            # Reject zip bombs before the response starts streaming
+            check_uploads(files)
+        except InvalidBatch as exc:
+            return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Create a watermarked file instance
-        watermarked_file = WatermarkedFile(
-            user=request.user,
-            original_file=file,
-            file_type='PDF' if file.name.lower().endswith('.pdf') else 'IMAGE'
+        results = watermark_batch(
+            iter_uploads(files),
+            params['watermark_template'],
+            params['position_x'],
+            params['position_y'],
+            params['opacity'],
+            params['rotation'],
+            output_options=encoder_options(
+                params['watermark_template'],
+                WatermarkSettings.objects.filter(user=request.user).first()
+            )
         )
+        response = StreamingHttpResponse(stream_batch_zip(results), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="watermarked_batch.zip"'
+        return stream_response(request, response)
+
+class WatermarkPreviewView(AdmissionErrorMixin, APIView):
+    permission_classes = [permissions.IsAuthenticated]
+    parser_classes = (MultiPartParser, FormParser)
+
+    def post(self, request):
+        serializer = WatermarkPreviewSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
         
-        if watermark_text:
-            # Create text watermark
-            img = Image.new('RGBA', (500, 100), (255, 255, 255, 0))
-            draw = ImageDraw.Draw(img)
-            font = ImageFont.truetype("arial.ttf", 36)
-            draw.text((10, 10), watermark_text, font=font, fill=(0, 0, 0, 128))
-            
-            # Save temporary watermark
-            temp_watermark = io.BytesIO()
-            img.save(temp_watermark, format='PNG')
-            watermark = temp_watermark.getvalue()
-        elif watermark_image:
-            watermark = watermark_image.read()
+        source = params.get('source')
+        file = request.FILES.get('file')
+        content_hash = None
+        if source is not None:
+            file, file_type, content_hash = source.original_file, source.file_type, source.content_hash
+        elif file is not None:
+            try:
+                file_type = detect_file_type(file)
+            except UnsupportedFile as exc:
+                return Response({'error': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
         else:
-            return Response({'error': 'No watermark provided'}, 
-                          status=status.HTTP_400_BAD_REQUEST)
+            return Response({'error': 'No file or source provided'}, status=status.HTTP_400_BAD_REQUEST)
+        check_admissible(file)
         
-        if watermarked_file.file_type == 'PDF':
-            # Process PDF watermark
-            pdf_reader = PyPDF2.PdfReader(file)
-            pdf_writer = PyPDF2.PdfWriter()
-            
-            watermark_pdf = PyPDF2.PdfReader(io.BytesIO(watermark))
-            watermark_page = watermark_pdf.pages[0]
-            
-            for page in pdf_reader.pages:
-                page.merge_page(watermark_page)
-                pdf_writer.add_page(page)
-            
-            output = io.BytesIO()
-            pdf_writer.write(output)
-            watermarked_file.watermarked_file.save(f'quick_watermarked_{file.name}', 
-                                                 output)
+        max_size = min(params.get('max_size') or preview_max_size(), preview_max_size())
+        content, content_type = render_preview(
+            file, file_type, params['watermark_template'],
+            opacity=params['opacity'],
+            rotation=params['rotation'],
+            pages=params['pages'],
+            max_size=max_size,
+            content_hash=content_hash or None
+        )
+        return HttpResponse(content, content_type=content_type)
+
+class QuickWatermarkView(AdmissionErrorMixin, APIView):
+    permission_classes = [permissions.IsAuthenticated]
+    parser_classes = (MultiPartParser, FormParser)
+
+    def post(self, request):
+        serializer = QuickWatermarkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        file = params['file']
+        
+        # Same rendering as the quick watermark page, see core.views
+        args = (file, params.get('watermark_text'), params.get('watermark_image'),
+                params['position_x'], params['position_y'], params['opacity'], params['rotation'])
+        file_type = preflight(file).file_type
+        if file_type == 'PDF':
+            processed_file = process_pdf_watermark_quick(*args)
         else:
-            # Process image watermark
-            with Image.open(file) as img:
-                watermark = Image.open(io.BytesIO(watermark))
-                
-                # Resize watermark
-                watermark = watermark.resize((img.width // 2, img.height // 2))
-                position = ((img.width - watermark.width) // 2,
-                          (img.height - watermark.height) // 2)
-                
-                transparent = Image.new('RGBA', img.size, (0, 0, 0, 0))
-                transparent.paste(img, (0, 0))
-                transparent.paste(watermark, position, mask=watermark)
-                
-                output = io.BytesIO()
-                transparent.save(output, format='PNG')
-                watermarked_file.watermarked_file.save(
-                    f'quick_watermarked_{file.name}', output)
+            user_settings = WatermarkSettings.objects.filter(user=request.user).first()
+            processed_file = process_image_watermark_quick(
+                *args, output_options=encoder_options(user_settings=user_settings))
         
-        watermarked_file.save()
+        watermarked_file = WatermarkedFile(
+            user=request.user,
+            original_file=file,
+            file_type=file_type,
+            status='DONE'
+        )
+        with stage('store'):
+            watermarked_file.watermarked_file.save(f'quick_{processed_file.name}', processed_file, save=False)
+            watermarked_file.save()
         return Response({
             'status': 'success',
             'watermarked_file_url': watermarked_file.watermarked_file.url
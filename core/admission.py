@@ -0,0 +1,250 @@
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+import warnings
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse
+from PIL import Image
+
+from .metrics import stage
+from .preflight import UnsupportedFile, preflight
+
+# Bytes per pixel of a decoded image by Pillow mode
+MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'LA': 2, 'PA': 2, 'I;16': 2, 'I;16B': 2, 'I;16L': 2,
+              'RGB': 3, 'YCbCr': 3, 'LAB': 3, 'HSV': 3, 'RGBA': 4, 'RGBa': 4, 'RGBX': 4,
+              'CMYK': 4, 'I': 4, 'F': 4}
+# The decoded image, the working copy watermarks are blended into and the
+# encoder's buffer are alive at the same time
+IMAGE_COPIES = 3
+
+
+class AdmissionError(Exception):
+    status_code = 503
+    retry_after = None
+
+
+class InputTooLarge(AdmissionError):
+    """The input can never be processed within the configured limits."""
+    status_code = 413
+
+
+class AdmissionBusy(AdmissionError):
+    """Too many jobs are already waiting for memory."""
+    status_code = 429
+    retry_after = 5
+
+
+class AdmissionTimeout(AdmissionError):
+    """Memory did not free up in time."""
+    status_code = 503
+    retry_after = 10
+
+
+def max_image_pixels():
+    return getattr(settings, 'WATERMARK_MAX_IMAGE_PIXELS', 178956970)
+
+
+def configure_pillow():
+    """Apply WATERMARK_MAX_IMAGE_PIXELS to every Image.open in the process.
+
+    Pillow only warns between MAX_IMAGE_PIXELS and twice that; turning the
+    warning into an error makes the limit the same for every code path.
+    """
+    Image.MAX_IMAGE_PIXELS = max_image_pixels()
+    warnings.simplefilter('error', Image.DecompressionBombWarning)
+
+
+def estimate_cost(info):
+    """Estimate the peak memory, in bytes, of watermarking a file from its Preflight."""
+    if info.file_type == 'PDF':
+        max_pages = getattr(settings, 'WATERMARK_MAX_PDF_PAGES', None)
+        if max_pages and info.pages > max_pages:
+            raise InputTooLarge(f'PDF has {info.pages} pages, the limit is {max_pages}')
+        # Parsed objects typically take about twice their serialised size
+        return 2 * (info.size or 0) + info.pages * getattr(settings, 'WATERMARK_PDF_PAGE_COST', 64 * 1024)
+    pixels = info.width * info.height
+    if pixels > max_image_pixels():
+        raise InputTooLarge(f'Image is {pixels} pixels, the limit is {max_image_pixels()}')
+    return pixels * MODE_BYTES.get(info.mode, 4) * IMAGE_COPIES
+
+
+def estimate_file_cost(file):
+    try:
+        return estimate_cost(preflight(file))
+    except (Image.DecompressionBombError, Image.DecompressionBombWarning) as exc:
+        raise InputTooLarge(str(exc))
+
+
+class MemoryBudget:
+    """Reserve estimated job memory against this process's budget."""
+
+    def __init__(self, limit, max_waiting):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.used = 0
+        self._waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, cost, timeout):
+        with self._condition:
+            if self._waiting or self.used + cost > self.limit:
+                if self._waiting >= self.max_waiting:
+                    raise AdmissionBusy('Too many watermark jobs are waiting for memory')
+                self._waiting += 1
+                try:
+                    admitted = self._condition.wait_for(lambda: self.used + cost <= self.limit, timeout)
+                finally:
+                    self._waiting -= 1
+                if not admitted:
+                    raise AdmissionTimeout('Not enough memory for the watermark job, try again later')
+            self.used += cost
+
+    def release(self, cost):
+        with self._condition:
+            self.used -= cost
+            self._condition.notify_all()
+
+
+class HostBudget:
+    """Reserve estimated job memory against a budget shared by all local processes.
+
+    Reservations live in a small JSON ledger guarded by flock; entries of
+    processes that died without releasing them are dropped on the next update.
+    """
+
+    def __init__(self, limit, path):
+        self.limit = limit
+        self.path = path
+
+    @staticmethod
+    def _alive(token):
+        try:
+            os.kill(int(token.split(':')[0]), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _update(self, change):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'a+') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            fh.seek(0)
+            try:
+                ledger = json.loads(fh.read() or '{}')
+            except ValueError:
+                ledger = {}
+            ledger = {token: cost for token, cost in ledger.items() if self._alive(token)}
+            result = change(ledger)
+            fh.seek(0)
+            fh.truncate()
+            json.dump(ledger, fh)
+            return result
+
+    def try_acquire(self, token, cost):
+        def reserve(ledger):
+            if sum(ledger.values()) + cost > self.limit:
+                return False
+            ledger[token] = cost
+            return True
+
+        return self._update(reserve)
+
+    def release(self, token):
+        self._update(lambda ledger: ledger.pop(token, None))
+
+
+_budgets = {}
+_budgets_lock = threading.Lock()
+
+
+def _process_budget():
+    limit = getattr(settings, 'WATERMARK_MEMORY_BUDGET', None)
+    if not limit:
+        return None
+    max_waiting = getattr(settings, 'WATERMARK_ADMISSION_MAX_WAITING', 32)
+    with _budgets_lock:
+        budget = _budgets.get('process')
+        if budget is None or (budget.limit, budget.max_waiting) != (limit, max_waiting):
+            budget = _budgets['process'] = MemoryBudget(limit, max_waiting)
+        return budget
+
+
+def _host_budget():
+    limit = getattr(settings, 'WATERMARK_HOST_MEMORY_BUDGET', None)
+    if not limit:
+        return None
+    directory = getattr(settings, 'WATERMARK_ADMISSION_DIR', None) or os.path.join(
+        tempfile.gettempdir(), 'watermark-admission')
+    return HostBudget(limit, os.path.join(directory, 'ledger.json'))
+
+
+@contextmanager
+def admit(cost, timeout=None):
+    """Hold ``cost`` bytes of the process and host memory budgets for the block.
+
+    Waits up to WATERMARK_ADMISSION_TIMEOUT seconds for memory, raising
+    AdmissionTimeout after that, AdmissionBusy if too many jobs are already
+    waiting and InputTooLarge if the job could never fit.
+    """
+    process_budget, host_budget = _process_budget(), _host_budget()
+    for budget in (process_budget, host_budget):
+        if budget is not None and cost > budget.limit:
+            raise InputTooLarge(f'The job needs about {cost} bytes, more than the {budget.limit} byte budget')
+    if timeout is None:
+        timeout = getattr(settings, 'WATERMARK_ADMISSION_TIMEOUT', 30)
+    deadline = time.monotonic() + timeout
+
+    token = None
+    with stage('admission'):
+        if process_budget is not None:
+            process_budget.acquire(cost, timeout)
+        if host_budget is not None:
+            token = f'{os.getpid()}:{uuid.uuid4().hex}'
+            while not host_budget.try_acquire(token, cost):
+                if time.monotonic() >= deadline:
+                    if process_budget is not None:
+                        process_budget.release(cost)
+                    raise AdmissionTimeout('Not enough memory on this host for the watermark job, try again later')
+                time.sleep(0.05)
+    try:
+        yield
+    finally:
+        if token is not None:
+            host_budget.release(token)
+        if process_budget is not None:
+            process_budget.release(cost)
+
+
+@contextmanager
+def admit_file(file, timeout=None):
+    """admit() the estimated cost of watermarking ``file``."""
+    with admit(estimate_file_cost(file), timeout):
+        yield
+
+
+def check_admissible(file):
+    """Reject inputs that could never be admitted, before they are stored."""
+    try:
+        cost = estimate_file_cost(file)
+    except (OSError, UnsupportedFile):
+        # Left to the caller's type check or the decoder to report
+        return
+    for budget in (_process_budget(), _host_budget()):
+        if budget is not None and cost > budget.limit:
+            raise InputTooLarge(f'The file needs about {cost} bytes to watermark, more than the '
+                                f'{budget.limit} byte budget')
+
+
+def admission_response(exc):
+    response = HttpResponse(str(exc), status=exc.status_code, content_type='text/plain; charset=utf-8')
+    if exc.retry_after:
+        response['Retry-After'] = str(exc.retry_after)
+    return response
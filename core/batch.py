@@ -0,0 +1,199 @@
+import json
+import os
+import posixpath
+import zipfile
+from collections import deque
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+from .pools import discard_pool, shared_pool
+from .preflight import detect_file_type
+
+
+class InvalidBatch(ValueError):
+    pass
+
+
+def batch_workers():
+    return getattr(settings, 'WATERMARK_BATCH_WORKERS', None) or os.cpu_count()
+
+
+def is_archive(uploaded):
+    return uploaded.name.lower().endswith('.zip')
+
+
+def check_uploads(files):
+    """Raise InvalidBatch unless the batch fits the WATERMARK_BATCH_MAX_* limits.
+
+    ZIP archives are checked from their central directory, before anything
+    is decompressed. The declared sizes can be trusted: zipfile never returns
+    more than ``file_size`` bytes for a member.
+    """
+    max_files = getattr(settings, 'WATERMARK_BATCH_MAX_FILES', 1000)
+    max_file_size = getattr(settings, 'WATERMARK_BATCH_MAX_FILE_SIZE', 256 * 1024 * 1024)
+    max_bytes = getattr(settings, 'WATERMARK_BATCH_MAX_BYTES', 1024 * 1024 * 1024)
+    max_ratio = getattr(settings, 'WATERMARK_BATCH_MAX_RATIO', 100)
+    count = total = 0
+    for uploaded in files:
+        if is_archive(uploaded):
+            try:
+                with zipfile.ZipFile(uploaded) as archive:
+                    entries = [info for info in archive.infolist() if not info.is_dir()]
+            except zipfile.BadZipFile as exc:
+                raise InvalidBatch(f'{uploaded.name}: {exc}')
+            finally:
+                uploaded.seek(0)
+            for info in entries:
+                if info.file_size > max_ratio * max(info.compress_size, 1):
+                    raise InvalidBatch(f'{uploaded.name}: {info.filename} is compressed more than {max_ratio}:1')
+            sizes = [info.file_size for info in entries]
+        else:
+            sizes = [uploaded.size]
+        for size in sizes:
+            count += 1
+            total += size
+            if count > max_files:
+                raise InvalidBatch(f'A batch can hold at most {max_files} files')
+            if size > max_file_size:
+                raise InvalidBatch(f'Files in a batch can be at most {max_file_size} bytes')
+            if total > max_bytes:
+                raise InvalidBatch(f'A batch can hold at most {max_bytes} bytes')
+
+
+def safe_name(name):
+    """Relative POSIX form of an archive member name, without '..', drive or root parts."""
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.', '..')]
+    if parts and parts[0].endswith(':'):
+        parts = parts[1:]
+    return '/'.join(parts) or 'file'
+
+
+def iter_uploads(files):
+    """Yield (name, bytes) for uploaded files, expanding ZIP archives.
+
+    Call check_uploads() first; entries are decompressed one at a time.
+    """
+    for uploaded in files:
+        if is_archive(uploaded):
+            with zipfile.ZipFile(uploaded) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir():
+                        yield info.filename, archive.read(info)
+        else:
+            yield uploaded.name, uploaded.read()
+
+
+def watermark_item(name, data, watermark_template, pos_x, pos_y, opacity, rotation, output_options=None):
+    """Watermark one batch item, returning (output_bytes, extension, error)."""
+    from .views import process_image_watermark, process_pdf_watermark
+
+    file = ContentFile(data, name=name)
+    args = (file, watermark_template, pos_x, pos_y, opacity, rotation)
+    try:
+        # Routed by content, so misnamed files still work and others fail fast
+        if detect_file_type(file) == 'PDF':
+            processed = process_pdf_watermark(*args)
+        else:
+            processed = process_image_watermark(*args, output_options=output_options)
+        processed.seek(0)
+        return processed.read(), os.path.splitext(processed.name)[1], None
+    except Exception as exc:
+        return None, None, str(exc)
+
+
+def _ordered_map(pool, fn, items, window):
+    # Like Executor.map, but only keeps ``window`` items in flight so a huge
+    # batch is never loaded into memory all at once.
+    pending = deque()
+    for item in items:
+        pending.append((item[0], pool.submit(fn, *item)))
+        if len(pending) >= window:
+            name, future = pending.popleft()
+            yield name, future.result()
+    while pending:
+        name, future = pending.popleft()
+        yield name, future.result()
+
+
+def watermark_batch(items, watermark_template, pos_x, pos_y, opacity, rotation,
+                    output_options=None):
+    """Watermark ``items`` in the shared batch pool, yielding results in input order.
+
+    The pool is shared by every batch of the process, so concurrent batches
+    queue for its WATERMARK_BATCH_WORKERS processes instead of adding more.
+    """
+    workers = batch_workers()
+    args = (
+        (name, data, watermark_template, pos_x, pos_y, opacity, rotation, output_options)
+        for name, data in items
+    )
+    pool = shared_pool('batch', workers)
+    try:
+        yield from _ordered_map(pool, watermark_item, args, workers * 2)
+    except BrokenProcessPool:
+        discard_pool('batch', pool)
+        raise
+
+
+class _ZipStream:
+    """Write-only buffer that lets ZipFile produce an archive incrementally."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _unique_name(name, used):
+    base, extension = os.path.splitext(name)
+    candidate, counter = name, 1
+    while candidate in used:
+        candidate = f'{base}-{counter}{extension}'
+        counter += 1
+    used.add(candidate)
+    return candidate
+
+
+def stream_batch_zip(results):
+    """Stream a ZIP of watermarked outputs followed by a manifest.json."""
+    stream = _ZipStream()
+    manifest = []
+    used = set()
+    with zipfile.ZipFile(stream, 'w') as archive:
+        try:
+            for name, (data, extension, error) in results:
+                if error is not None:
+                    manifest.append({'name': name, 'status': 'error', 'error': error})
+                    continue
+                # Member names come from the client and may try to escape the archive
+                directory, filename = posixpath.split(safe_name(name))
+                output_name = posixpath.join(directory, f'watermarked_{os.path.splitext(filename)[0]}{extension}')
+                output_name = _unique_name(output_name, used)
+                # Outputs are already compressed images and PDFs
+                archive.writestr(output_name, data, compress_type=zipfile.ZIP_STORED)
+                manifest.append({'name': name, 'status': 'ok', 'output': output_name})
+                yield stream.drain()
+        except BrokenProcessPool as exc:
+            # The response has started, so finish a valid archive that says so
+            manifest.append({'name': None, 'status': 'error',
+                             'error': f'Batch aborted, a worker process died: {exc}'})
+        archive.writestr('manifest.json', json.dumps(manifest, indent=2),
+                         compress_type=zipfile.ZIP_DEFLATED)
+    yield stream.drain()
@@ -0,0 +1,83 @@
+import uuid
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image
+
+from .encoding import encode_image
+
+# resize() first shrinks by an integer factor with reduce() (a cheap box
+# average) while the result stays at least this many times the target, then
+# resamples the rest with Lanczos
+REDUCING_GAP = 3.0
+
+
+def derivative_sizes():
+    """Name -> longest side in pixels of the sized variants to emit with each output."""
+    return getattr(settings, 'WATERMARK_DERIVATIVES', {})
+
+
+def downscale(img, sizes):
+    """Yield (name, image) for each entry of ``sizes`` smaller than ``img``.
+
+    Variants are produced largest first and each one is resized from the
+    previous one, so the full-size image is only read once however many
+    variants there are. Sizes that would not shrink the image are skipped;
+    the main output already covers them.
+    """
+    longest = max(img.size)
+    current = img
+    for name, max_side in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+        if max_side >= longest:
+            continue
+        scale = max_side / longest
+        target = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        current = current.resize(target, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+        yield name, current
+
+
+def render_derivatives(img, sizes, source_format, info, output_options=None):
+    """Encode the variants of an already composited ``img``.
+
+    Returns name -> ContentFile, each carrying ``width`` and ``height``; they
+    are encoded like the main output.
+    """
+    derivatives = {}
+    for name, variant in downscale(img, sizes):
+        data, extension = encode_image(variant, source_format, info, output_options)
+        derivative = ContentFile(data, name=f'{name}{extension}')
+        derivative.width, derivative.height = variant.size
+        derivatives[name] = derivative
+    return derivatives
+
+
+def derivative_name(render_key, derivative):
+    # Keyed by the render recipe and the pixel size, so rows sharing an
+    # output through their render key share its variants too
+    return f'watermarked_files/derivatives/{render_key[:2]}/{render_key}-{derivative.width}x{derivative.height}-{derivative.name}'
+
+
+def store_derivatives(storage, render_key, derivatives):
+    """Save rendered variants; returns what WatermarkedFile.derivatives records."""
+    render_key = render_key or uuid.uuid4().hex
+    stored = {}
+    for name, derivative in derivatives.items():
+        file_name = derivative_name(render_key, derivative)
+        if not storage.exists(file_name):
+            file_name = storage.save(file_name, derivative)
+        stored[name] = {
+            'name': file_name,
+            'width': derivative.width,
+            'height': derivative.height,
+            'size': derivative.size,
+        }
+    return stored
+
+
+def delete_derivatives(storage, stored):
+    for derivative in stored.values():
+        storage.delete(derivative['name'])
+
+
+def derivatives_size(stored):
+    return sum(derivative['size'] for derivative in stored.values())
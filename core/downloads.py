@@ -0,0 +1,150 @@
+import hashlib
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+
+from .executors import stream_response
+
+DOWNLOAD_BACKENDS = (None, 'x-accel-redirect', 'x-sendfile')
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def download_backend():
+    backend = getattr(settings, 'WATERMARK_DOWNLOAD_BACKEND', None)
+    if backend not in DOWNLOAD_BACKENDS:
+        raise ValueError(f'Unknown download backend {backend!r}')
+    return backend
+
+
+def file_etag(field_file, content_hash=''):
+    """Strong ETag from the digest identifying the content and the stored name.
+
+    The name changes whenever an output is rendered again, so a resumed
+    Range request never mixes bytes of two renders.
+    """
+    tag = f'{content_hash}:{field_file.name}:{field_file.size}'
+    return '"%s"' % hashlib.sha256(tag.encode('utf-8')).hexdigest()
+
+
+def _modified_time(field_file):
+    try:
+        return int(field_file.storage.get_modified_time(field_file.name).timestamp())
+    except (NotImplementedError, OSError):
+        return None
+
+
+def parse_range(header, size):
+    """Return (start, stop) for a single byte range, None to send everything,
+    or False if the range cannot be satisfied.
+
+    Multiple ranges are answered with the whole file, as RFC 9110 allows.
+    """
+    match = _RANGE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # Suffix range: the last N bytes
+        length = min(int(last), size)
+        return (size - length, size) if length else False
+    start = int(first)
+    if last and int(last) < start:
+        # Not a valid range, so the header is ignored (RFC 9110, 14.1.1)
+        return None
+    if start >= size:
+        return False
+    return start, (min(int(last) + 1, size) if last else size)
+
+
+def _if_range_matches(request, etag, last_modified):
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    since = parse_http_date_safe(if_range)
+    return since is not None and last_modified is not None and int(last_modified) <= since
+
+
+def _iter_range(fh, start, length, chunk_size=FileResponse.block_size):
+    try:
+        fh.seek(start)
+        while length:
+            data = fh.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fh.close()
+
+
+def _delegate(field_file, backend):
+    response = HttpResponse()
+    if backend == 'x-accel-redirect':
+        prefix = getattr(settings, 'WATERMARK_X_ACCEL_PREFIX', '/protected-media/')
+        response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(field_file.name)
+    else:
+        response['X-Sendfile'] = field_file.path
+    # Let the front-end server pick the type and handle Range itself
+    del response['Content-Type']
+    return response
+
+
+def serve_file(request, field_file, filename=None, content_hash=''):
+    """Answer a download of a stored file.
+
+    Handles If-None-Match/If-Modified-Since (304) and single Range requests
+    (206/416). With WATERMARK_DOWNLOAD_BACKEND set, only headers are returned
+    and nginx (X-Accel-Redirect) or Apache/lighttpd (X-Sendfile) send the
+    bytes, so no worker is tied up copying large files.
+    """
+    filename = filename or os.path.basename(field_file.name)
+    etag = file_etag(field_file, content_hash)
+    last_modified = _modified_time(field_file)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = _file_response(request, field_file, etag, last_modified)
+
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    response['Content-Disposition'] = content_disposition_header(True, filename)
+    response['Cache-Control'] = 'private'
+    return stream_response(request, response)
+
+
+def _file_response(request, field_file, etag, last_modified):
+    backend = download_backend()
+    if backend:
+        return _delegate(field_file, backend)
+
+    size = field_file.size
+    content_type = mimetypes.guess_type(field_file.name)[0] or 'application/octet-stream'
+    byte_range = None
+    if request.method in ('GET', 'HEAD') and _if_range_matches(request, etag, last_modified):
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+    elif byte_range is None:
+        response = FileResponse(field_file.open('rb'), content_type=content_type)
+    else:
+        start, stop = byte_range
+        response = StreamingHttpResponse(
+            _iter_range(field_file.open('rb'), start, stop - start), status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        response['Content-Length'] = str(stop - start)
+    response['Accept-Ranges'] = 'bytes'
+    return response
@@ -0,0 +1,94 @@
+import io
+
+OUTPUT_FORMAT_CHOICES = [
+    ('ORIGINAL', 'Same as original'),
+    ('JPEG', 'JPEG'),
+    ('WEBP', 'WebP'),
+    ('PNG', 'PNG')
+]
+
+EXTENSIONS = {
+    'JPEG': '.jpg',
+    'WEBP': '.webp',
+    'PNG': '.png',
+    'TIFF': '.tif',
+}
+
+DEFAULT_OPTIONS = {
+    'format': 'ORIGINAL',
+    'jpeg_quality': 85,
+    'webp_quality': 80,
+    'png_compress_level': 6,
+    'optimize': False,
+    'keep_metadata': True,
+}
+
+
+def encoder_options(watermark_template=None, user_settings=None):
+    """Merge encoder settings: defaults < WatermarkSettings < template overrides."""
+    options = dict(DEFAULT_OPTIONS)
+    if user_settings is not None:
+        options.update(
+            format=user_settings.output_format,
+            jpeg_quality=user_settings.jpeg_quality,
+            webp_quality=user_settings.webp_quality,
+            png_compress_level=user_settings.png_compress_level,
+            optimize=user_settings.optimize,
+            keep_metadata=user_settings.keep_metadata,
+        )
+    if watermark_template is not None:
+        if watermark_template.output_format:
+            options['format'] = watermark_template.output_format
+        if watermark_template.quality is not None:
+            options['jpeg_quality'] = options['webp_quality'] = watermark_template.quality
+    return options
+
+
+def recipe_options(file_type, watermark_template=None, user_settings=None):
+    """Encoder options stored with a WatermarkedFile recipe when it is created."""
+    if file_type == 'PDF':
+        return {'format': 'PDF'}
+    return encoder_options(watermark_template, user_settings)
+
+
+def resolve_format(requested, source_format):
+    if requested and requested != 'ORIGINAL':
+        return requested
+    return source_format if source_format in EXTENSIONS else 'PNG'
+
+
+def encode_image(img, source_format, info, options=None):
+    """Encode ``img`` according to ``options``; returns (bytes, extension).
+
+    ``source_format`` and ``info`` are the decoded original's ``format`` and
+    ``info`` so the original format, EXIF and ICC profile can be preserved.
+    """
+    options = options or DEFAULT_OPTIONS
+    output_format = resolve_format(options['format'], source_format)
+    params = {}
+
+    if options['keep_metadata']:
+        if info.get('icc_profile'):
+            params['icc_profile'] = info['icc_profile']
+        if info.get('exif'):
+            params['exif'] = info['exif']
+
+    if img.mode == 'CMYK' and output_format not in ('JPEG', 'TIFF'):
+        # A CMYK profile does not describe the converted pixels
+        img = img.convert('RGB')
+        params.pop('icc_profile', None)
+
+    if output_format == 'JPEG':
+        if img.mode not in ('RGB', 'L', 'CMYK'):
+            img = img.convert('RGB')
+        params.update(quality=options['jpeg_quality'], optimize=options['optimize'])
+    elif output_format == 'WEBP':
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA')
+        params.update(quality=options['webp_quality'], method=6 if options['optimize'] else 4)
+    elif output_format == 'PNG':
+        params.update(compress_level=options['png_compress_level'], optimize=options['optimize'])
+
+    output = io.BytesIO()
+    img.save(output, format=output_format, **params)
+    return output.getvalue(), EXTENSIONS[output_format]
@@ -0,0 +1,86 @@
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def render_workers():
+    return getattr(settings, 'WATERMARK_ASYNC_RENDER_WORKERS', None) or os.cpu_count()
+
+
+def render_executor():
+    """The bounded thread pool async views run decoding and rendering in.
+
+    However many uploads an ASGI worker is receiving, at most
+    WATERMARK_ASYNC_RENDER_WORKERS of them are processed at once; the rest
+    wait in the queue without holding a thread.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=render_workers(), thread_name_prefix='watermark-render')
+        return _executor
+
+
+def _call(func, args, kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # Pool threads outlive requests, so nothing else closes their connections
+        close_old_connections()
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Await ``func(*args, **kwargs)`` run in the render executor.
+
+    The caller's context is carried over so metrics stages still reach the
+    request's Server-Timing header.
+    """
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, _call, func, args, kwargs)
+    return await asyncio.get_running_loop().run_in_executor(render_executor(), call)
+
+
+_DONE = object()
+
+
+async def aiter_blocking(iterable):
+    """Async iterator over a blocking ``iterable``, advanced via run_blocking().
+
+    Each chunk is produced in the render executor, so file reads and ZIP
+    generation never block the event loop and only one chunk is in memory.
+    """
+    iterator = iter(iterable)
+    try:
+        while True:
+            chunk = await run_blocking(next, iterator, _DONE)
+            if chunk is _DONE:
+                break
+            yield chunk
+    finally:
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            await run_blocking(close)
+
+
+def stream_response(request, response):
+    """Make a streaming ``response`` stream under ASGI too.
+
+    Django reads a synchronous iterator completely into memory before
+    sending it over ASGI, so there the content is swapped for an async
+    iterator; under WSGI the response is returned unchanged.
+    """
+    # DRF wraps the Django request
+    request = getattr(request, '_request', request)
+    if response.streaming and not response.is_async and isinstance(request, ASGIRequest):
+        response.streaming_content = aiter_blocking(response.streaming_content)
+    return response
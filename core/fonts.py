@@ -0,0 +1,162 @@
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+
+from django.conf import settings
+from PIL import Image, ImageDraw, ImageFont
+
+from .compositing import composite_clipped
+
+SYSTEM_FONTS = [
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    '/System/Library/Fonts/Helvetica.ttc',
+    'C:\\Windows\\Fonts\\arial.ttf'
+]
+
+# A rendered piece of text. ``offset`` is where the sprite's top-left corner
+# lands relative to the xy passed to ImageDraw.text, so pasting the sprite at
+# (x + offset[0], y + offset[1]) matches drawing the text at (x, y).
+TextSprite = namedtuple('TextSprite', ['image', 'offset'])
+
+
+@lru_cache(maxsize=None)
+def default_font_path():
+    for font_path in SYSTEM_FONTS:
+        if os.path.exists(font_path):
+            return font_path
+    return None
+
+
+def get_default_font():
+    return default_font_path() or ImageFont.load_default()
+
+
+@lru_cache(maxsize=64)
+def get_font(size=36, path=None):
+    path = path or default_font_path()
+    if path is None:
+        return ImageFont.load_default()
+    return ImageFont.truetype(path, size)
+
+
+class SpriteCache:
+    """LRU of rendered text sprites bounded by total pixel buffer size."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cost(sprite):
+        return sprite.image.width * sprite.image.height * len(sprite.image.getbands())
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            sprite = self._entries.get(key)
+            if sprite is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return sprite
+            self.misses += 1
+
+        sprite = render()
+        cost = self._cost(sprite)
+        if cost > self.max_bytes:
+            return sprite
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = sprite
+                self.current_bytes += cost
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= self._cost(evicted)
+        return sprite
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+sprite_cache = SpriteCache(getattr(settings, 'WATERMARK_TEXT_SPRITE_CACHE_BYTES', 32 * 1024 * 1024))
+
+
+def _text_bbox(text, font):
+    return ImageDraw.Draw(Image.new('RGBA', (1, 1))).textbbox((0, 0), text, font=font)
+
+
+def _render_sprite(text, size, fill, font_path):
+    font = get_font(size, font_path)
+    left, top, right, bottom = _text_bbox(text, font)
+    image = Image.new('RGBA', (max(right - left, 1), max(bottom - top, 1)), fill[:3] + (0,))
+    ImageDraw.Draw(image).text((-left, -top), text, font=font, fill=fill)
+    return TextSprite(image, (left, top))
+
+
+def text_sprite(text, size=36, fill=(255, 255, 255, 255), font_path=None):
+    """Return a cached TextSprite; callers must not modify its image."""
+    fill = tuple(fill)
+    key = (text, font_path or default_font_path(), size, fill)
+    return sprite_cache.get_or_render(key, lambda: _render_sprite(text, size, fill, font_path))
+
+
+def _render_row_tile(text, size, fill, spacing, font_path):
+    font = get_font(size, font_path)
+    left, top, right, bottom = _text_bbox(text, font)
+    tile = Image.new('RGBA', (spacing, max(bottom - top, 1)), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(tile)
+    # Every copy that reaches into the period, left to right like the full row
+    for x in range(-(max(right, 1) // spacing + 1) * spacing, spacing - min(left, 0), spacing):
+        draw.text((x, -top), text, font=font, fill=fill)
+    return TextSprite(tile, (0, top))
+
+
+def text_row_tile(text, size, spacing, fill=(255, 255, 255, 255), font_path=None):
+    """One period of a row of ``text`` drawn every ``spacing`` pixels, cached.
+
+    The copies are drawn with ImageDraw.text onto one transparent layer, so
+    where they overlap they blend exactly as drawing the whole row would.
+    ``offset`` is where the tile lands relative to the xy of a copy.
+    """
+    fill = tuple(fill)
+    key = ('row', text, font_path or default_font_path(), size, fill, spacing)
+    return sprite_cache.get_or_render(key, lambda: _render_row_tile(text, size, fill, spacing, font_path))
+
+
+def text_row_strip(text, size, fill, start, spacing, width, font_path=None):
+    """The whole row of ``text`` drawn every ``spacing`` pixels from x=``start``, uncached."""
+    font = get_font(size, font_path)
+    left, top, right, bottom = _text_bbox(text, font)
+    strip = Image.new('RGBA', (width, max(bottom - top, 1)), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(strip)
+    for x in range(start, width, spacing):
+        draw.text((x, -top), text, font=font, fill=tuple(fill))
+    return TextSprite(strip, (0, top))
+
+
+def text_width(text, size=36, font_path=None):
+    """Right edge of ``text`` drawn at x=0."""
+    return _text_bbox(text, get_font(size, font_path))[2]
+
+
+def paste_sprite(layer, sprite, xy):
+    """Alpha-composite ``sprite`` onto ``layer`` in place, clipped to its bounds."""
+    composite_clipped(layer, sprite.image, (xy[0] + sprite.offset[0], xy[1] + sprite.offset[1]))
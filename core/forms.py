@@ -1,10 +1,12 @@
 from django import forms
+from .admission import InputTooLarge, check_admissible
+from .preflight import UnsupportedFile, detect_file_type, preflight
 from .models import WatermarkTemplate, WatermarkedFile, WatermarkSettings
 
 class WatermarkTemplateForm(forms.ModelForm):
     class Meta:
         model = WatermarkTemplate
-        fields = ['name', 'type', 'text', 'image']
+        fields = ['name', 'type', 'text', 'image', 'output_format', 'quality']
         widgets = {
             'type': forms.RadioSelect(),
         }
@@ -38,6 +40,18 @@ class FileUploadForm(forms.ModelForm):
         #     'rotation': forms.NumberInput(attrs={'type': 'range', 'min': '0', 'max': '360', 'step': '1'}),
         # }
 
+    def clean(self):
+        cleaned_data = super().clean()
+        original_file = cleaned_data.get('original_file')
+        if original_file:
+            try:
+                # Route by content rather than by what the user picked
+                cleaned_data['file_type'] = self.instance.file_type = detect_file_type(original_file)
+                check_admissible(original_file)
+            except (UnsupportedFile, InputTooLarge) as exc:
+                self.add_error('original_file', str(exc))
+        return cleaned_data
+
 class WatermarkSettingsForm(forms.ModelForm):
     class Meta:
         model = WatermarkSettings
@@ -46,6 +60,12 @@ class WatermarkSettingsForm(forms.ModelForm):
             'default_position_y',
             # 'default_opacity',
             # 'default_rotation'
+            'output_format',
+            'jpeg_quality',
+            'webp_quality',
+            'png_compress_level',
+            'optimize',
+            'keep_metadata',
         ]
         # widgets = {
         #     'default_opacity': forms.NumberInput(attrs={'type': 'range', 'min': '0', 'max': '1', 'step': '0.1'}),
@@ -67,6 +87,14 @@ class QuickWatermarkForm(forms.Form):
     #     widget=forms.NumberInput(attrs={'type': 'range', 'min': '0', 'max': '360', 'step': '1'})
     # )
 
+    def clean_file(self):
+        file = self.cleaned_data['file']
+        try:
+            preflight(file)
+        except UnsupportedFile as exc:
+            raise forms.ValidationError(str(exc))
+        return file
+
     def clean(self):
         cleaned_data = super().clean()
         watermark_text = cleaned_data.get('watermark_text')
@@ -0,0 +1,252 @@
+import io
+import re
+
+import PyPDF2
+from django.conf import settings
+from PyPDF2.generic import (ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject,
+                            StreamObject)
+
+from .stamps import BaseStamper, PageStamper
+
+PDF_WRITE_MODES = ('rewrite', 'incremental')
+
+_STARTXREF = re.compile(rb'startxref\s+(\d+)\s+%%EOF', re.S)
+_LOCAL_REFERENCE = re.compile(rb'\x00WatermarkRef(\d+)\x00')
+
+
+def pdf_write_mode():
+    mode = getattr(settings, 'WATERMARK_PDF_WRITE_MODE', 'incremental')
+    if mode not in PDF_WRITE_MODES:
+        raise ValueError(f'Unknown PDF write mode {mode!r}')
+    return mode
+
+
+def last_xref_offset(source):
+    """Offset of the last cross-reference section if it is a classic table, else None."""
+    matches = list(_STARTXREF.finditer(source, max(0, len(source) - 1024)))
+    if not matches:
+        return None
+    offset = int(matches[-1].group(1))
+    if source[offset:offset + 4] != b'xref':
+        # A cross-reference stream; its update would have to be one as well
+        return None
+    return offset
+
+
+def incremental_supported(reader, source):
+    """Return the offset to chain an update to, or None if the file needs a rewrite."""
+    if reader.is_encrypted:
+        return None
+    return last_xref_offset(source)
+
+
+def serialize_object(obj):
+    """Serialise ``obj`` as (dictionary_part, stream_part) without the obj/endobj wrapper.
+
+    Keeping stream data apart lets callers patch references in the dictionary
+    without any risk of touching binary data.
+    """
+    head = io.BytesIO()
+    if isinstance(obj, StreamObject):
+        obj[NameObject('/Length')] = NumberObject(len(obj._data))
+        DictionaryObject.write_to_stream(obj, head, None)
+        del obj['/Length']
+        return head.getvalue(), b'\nstream\n' + obj._data + b'\nendstream'
+    obj.write_to_stream(head, None)
+    return head.getvalue(), b''
+
+
+def write_update(output, source, trailer, xref_offset, objects, size):
+    """Write ``source`` followed by an incremental update holding ``objects``.
+
+    ``objects`` yields (number, generation, body) in output order.
+    """
+    output.write(source)
+    if source[-1:] != b'\n':
+        output.write(b'\n')
+
+    offsets = {}
+    for number, generation, body in objects:
+        offsets[number] = (output.tell(), generation)
+        output.write(b'%d %d obj\n%s\nendobj\n' % (number, generation, body))
+
+    xref = output.tell()
+    # The free-list head is repeated as readers expect every table to have it
+    lines = [b'xref\n0 1\n0000000000 65535 f\r\n']
+    numbers = sorted(offsets)
+    start = 0
+    while start < len(numbers):
+        end = start
+        while end + 1 < len(numbers) and numbers[end + 1] == numbers[end] + 1:
+            end += 1
+        lines.append(b'%d %d\n' % (numbers[start], end - start + 1))
+        for number in numbers[start:end + 1]:
+            offset, generation = offsets[number]
+            lines.append(b'%010d %05d n\r\n' % (offset, generation))
+        start = end + 1
+    output.write(b''.join(lines))
+
+    update_trailer = DictionaryObject()
+    for key in ('/Root', '/Info', '/ID'):
+        if key in trailer:
+            update_trailer[NameObject(key)] = trailer.raw_get(key)
+    update_trailer[NameObject('/Size')] = NumberObject(size)
+    update_trailer[NameObject('/Prev')] = NumberObject(xref_offset)
+    output.write(b'trailer\n')
+    update_trailer.write_to_stream(output, None)
+    output.write(b'\nstartxref\n%d\n%%%%EOF\n' % xref)
+
+
+class UpdateStamper(BaseStamper):
+    """Stamp pages of ``reader`` into new and changed objects instead of a PdfWriter.
+
+    The stamped page dictionaries and the objects created for them are
+    collected for an incremental update; subclasses decide how it is written.
+    """
+
+    def __init__(self, reader, source):
+        super().__init__()
+        self.reader = reader
+        self.source = source
+        self._next_number = int(reader.trailer['/Size'])
+        self._new_objects = []
+        self._changed = {}
+        self._imported = {}
+
+    def add_page(self, page, stamp):
+        page = super().add_page(page, stamp)
+        self._mark_changed(page)
+        return page
+
+    def _objects(self):
+        for (number, generation), obj in self._changed.items():
+            yield number, generation, obj
+        for ref, obj in self._new_objects:
+            yield ref.idnum, 0, obj
+
+    def _mark_changed(self, obj):
+        ref = obj.indirect_reference
+        self._changed[(ref.idnum, ref.generation)] = obj
+
+    def _reference(self):
+        ref = IndirectObject(self._next_number, 0, self.reader)
+        self._next_number += 1
+        return ref
+
+    def _place(self, page):
+        return page
+
+    def _add_object(self, obj):
+        ref = self._reference()
+        self._new_objects.append((ref, obj))
+        return ref
+
+    def _copy(self, obj):
+        # Deep copy of a stamp object graph with fresh object numbers
+        if isinstance(obj, IndirectObject):
+            key = (id(obj.pdf), obj.idnum, obj.generation)
+            if key not in self._imported:
+                target = obj.get_object()
+                placeholder = self._reference()
+                self._imported[key] = placeholder
+                self._new_objects.append((placeholder, self._copy(target)))
+            return self._imported[key]
+        if isinstance(obj, StreamObject):
+            copy = obj.__class__()
+            copy._data = obj._data
+            copy.update({key: self._copy(value) for key, value in obj.items()})
+            return copy
+        if isinstance(obj, DictionaryObject):
+            return DictionaryObject({key: self._copy(value) for key, value in obj.items()})
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self._copy(value) for value in obj)
+        return obj
+
+
+class IncrementalStamper(UpdateStamper):
+    """Stamp pages by appending a PDF incremental update to the original bytes.
+
+    The original file is copied through unchanged and followed by the new
+    Form XObjects and wrapper streams, the page dictionaries (and any shared
+    resource dictionaries) that now reference them, and a cross-reference
+    section whose /Prev points at the original one. Nothing already in the
+    file is re-serialised, and earlier revisions, signed ones included, stay
+    byte-for-byte intact.
+    """
+
+    def __init__(self, reader, source, xref_offset):
+        super().__init__(reader, source)
+        self.xref_offset = xref_offset
+
+    def add_page(self, page, stamp):
+        page = super().add_page(page, stamp)
+        for parent, key in ((page, '/Resources'), (page['/Resources'], '/XObject')):
+            value = parent.raw_get(key)
+            if isinstance(value, IndirectObject):
+                self._mark_changed(value.get_object())
+        return page
+
+    def write(self, output):
+        objects = ((number, generation, b''.join(serialize_object(obj)))
+                   for number, generation, obj in self._objects())
+        write_update(output, self.source, self.reader.trailer, self.xref_offset, objects,
+                     self._next_number)
+
+
+class _LocalReference(IndirectObject):
+    # Written as a marker the parent process replaces with the final number
+    def write_to_stream(self, stream, encryption_key):
+        stream.write(b'\x00WatermarkRef%d\x00' % self.idnum)
+
+
+class RangeStamper(UpdateStamper):
+    """UpdateStamper for one page range of a document split across processes.
+
+    New objects get range-local numbers, written as markers that
+    ``relocate`` turns into real references once the parent knows how many
+    objects the earlier ranges added. Only page dictionaries are rewritten:
+    shared resource dictionaries are copied into the page instead, so two
+    ranges never update the same object.
+    """
+
+    def __init__(self, reader, source, index):
+        super().__init__(reader, source)
+        self.name_prefix = f'/WatermarkStamp{index}_'
+        self._next_number = 0
+
+    def fragments(self):
+        """Return (changed, new): serialised rewritten pages and new objects."""
+        changed = [(number, generation, serialize_object(obj))
+                   for (number, generation), obj in self._changed.items()]
+        new = [serialize_object(obj) for _, obj in sorted(self._new_objects, key=lambda item: item[0].idnum)]
+        return changed, new
+
+    def _reference(self):
+        ref = _LocalReference(self._next_number, 0, None)
+        self._next_number += 1
+        return ref
+
+    def _subdictionary(self, parent, key):
+        value = parent.get(key)
+        if isinstance(value, IndirectObject):
+            parent[NameObject(key)] = DictionaryObject(value.get_object())
+        return super()._subdictionary(parent, key)
+
+
+def relocate(fragment, base):
+    """Resolve the range-local references in a serialised fragment."""
+    head, tail = fragment
+    return _LOCAL_REFERENCE.sub(lambda match: b'%d 0 R' % (base + int(match[1])), head) + tail
+
+
+def pdf_stamper(pdf_reader, source):
+    """Return the stamper for the configured write mode.
+
+    Encrypted files and files whose last cross-reference section is a stream
+    fall back to rewriting the document with PdfWriter.
+    """
+    if pdf_write_mode() == 'incremental':
+        xref_offset = incremental_supported(pdf_reader, source)
+        if xref_offset is not None:
+            return IncrementalStamper(pdf_reader, source, xref_offset)
+    return PageStamper(PyPDF2.PdfWriter())
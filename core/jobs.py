@@ -0,0 +1,186 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+from django.utils import timezone
+
+from .admission import AdmissionBusy, AdmissionTimeout
+from .derivatives import delete_derivatives, derivative_sizes, store_derivatives
+from .metrics import job, stage
+from .pools import mark_worker
+from .models import WatermarkedFile
+
+logger = logging.getLogger(__name__)
+
+
+RENDER_MODES = ('eager', 'lazy')
+# Fields whose change makes an existing output stale
+RECIPE_FIELDS = ('original_file', 'watermark_template', 'position_x', 'position_y', 'opacity', 'rotation')
+
+
+def background_jobs_enabled():
+    return getattr(settings, 'WATERMARK_BACKGROUND_JOBS', False)
+
+
+def render_mode():
+    mode = getattr(settings, 'WATERMARK_RENDER_MODE', 'eager')
+    if mode not in RENDER_MODES:
+        raise ValueError(f'Unknown render mode {mode!r}')
+    return mode
+
+
+def enqueue(watermarked_file):
+    """Hand a saved WatermarkedFile to the worker pool.
+
+    With WATERMARK_BACKGROUND_JOBS disabled the file is rendered right away,
+    which keeps the development server usable without a running worker. In
+    the 'lazy' WATERMARK_RENDER_MODE only the recipe is kept and the output
+    is rendered on first download, see core.results.
+    """
+    if reuse_cached_result(watermarked_file):
+        return
+    if render_mode() == 'lazy':
+        watermarked_file.status = 'RECIPE'
+        watermarked_file.save(update_fields=['status'])
+    elif background_jobs_enabled():
+        watermarked_file.status = 'PENDING'
+        watermarked_file.attempts = 0
+        watermarked_file.not_before = None
+        watermarked_file.save(update_fields=['status', 'attempts', 'not_before'])
+    else:
+        run_job(watermarked_file.pk)
+
+
+def rerender(watermarked_file):
+    """Drop the output of a saved WatermarkedFile whose recipe changed and enqueue() it again."""
+    storage = watermarked_file.watermarked_file.storage
+    output, derivatives = watermarked_file.watermarked_file.name, watermarked_file.derivatives
+    watermarked_file.watermarked_file = ''
+    watermarked_file.derivatives = {}
+    watermarked_file.output_size = None
+    watermarked_file.status = 'PENDING'
+    watermarked_file.error = ''
+    watermarked_file.save()
+    # Other rows with the old recipe may share the output, see reuse_cached_result
+    if output and not WatermarkedFile.objects.filter(watermarked_file=output).exists():
+        storage.delete(output)
+        delete_derivatives(storage, derivatives)
+    enqueue(watermarked_file)
+
+
+def reuse_cached_result(watermarked_file):
+    """Point ``watermarked_file`` at an existing render of the same recipe.
+
+    Returns True when a finished output with the same render key exists, in
+    which case nothing needs to be rendered.
+    """
+    if not watermarked_file.update_render_key():
+        return False
+    cached = (
+        WatermarkedFile.objects
+        .filter(render_key=watermarked_file.render_key, status='DONE')
+        .exclude(pk=watermarked_file.pk)
+        .exclude(watermarked_file='')
+        .only('watermarked_file', 'derivatives')
+        .first()
+    )
+    if cached is None or not cached.watermarked_file.storage.exists(cached.watermarked_file.name):
+        return False
+    watermarked_file.watermarked_file.name = cached.watermarked_file.name
+    watermarked_file.derivatives = cached.derivatives
+    watermarked_file.status = 'DONE'
+    watermarked_file.error = ''
+    watermarked_file.save()
+    return True
+
+
+def render_watermarked_file(watermarked_file):
+    """Render and store the output; returns False if an existing one was reused."""
+    from .views import process_image_watermark, process_pdf_watermark
+
+    if watermarked_file.watermark_template is None:
+        raise ValueError('Watermark template no longer exists')
+    if reuse_cached_result(watermarked_file):
+        return False
+
+    args = (
+        watermarked_file.original_file,
+        watermarked_file.watermark_template,
+        watermarked_file.position_x,
+        watermarked_file.position_y,
+        watermarked_file.opacity,
+        watermarked_file.rotation
+    )
+    with job(watermarked_file.file_type, watermarked_file.watermark_template.type):
+        if watermarked_file.file_type == 'PDF':
+            processed_file = process_pdf_watermark(*args)
+        else:
+            # Thumbnails and sized variants come from the same decode and composite
+            processed_file = process_image_watermark(
+                *args, output_options=watermarked_file.output_options, derivatives=derivative_sizes()
+            )
+        watermarked_file.watermarked_file = processed_file
+        watermarked_file.status = 'DONE'
+        watermarked_file.error = ''
+        with stage('store'):
+            watermarked_file.derivatives = store_derivatives(
+                watermarked_file.watermarked_file.storage, watermarked_file.render_key,
+                getattr(processed_file, 'derivatives', {})
+            )
+            watermarked_file.save()
+    return True
+
+
+def retry_delay(attempts, exc):
+    """Seconds to wait before retrying a job deferred ``attempts`` times in a row."""
+    delay = (exc.retry_after or 1) * 2 ** (attempts - 1)
+    return min(delay, getattr(settings, 'WATERMARK_JOB_RETRY_MAX_DELAY', 300))
+
+
+def due_jobs():
+    return WatermarkedFile.objects.filter(
+        Q(not_before__isnull=True) | Q(not_before__lte=timezone.now()), status='PENDING'
+    )
+
+
+def claim_jobs(limit):
+    candidates = due_jobs().order_by('created_at').values_list('pk', flat=True)[:limit]
+    claimed = []
+    for pk in candidates:
+        # Conditional update so concurrent workers never claim the same row
+        if due_jobs().filter(pk=pk).update(status='PROCESSING'):
+            claimed.append(pk)
+    return claimed
+
+
+def requeue_interrupted():
+    return WatermarkedFile.objects.filter(status='PROCESSING').update(status='PENDING')
+
+
+def run_job(pk):
+    watermarked_file = WatermarkedFile.objects.select_related('watermark_template').get(pk=pk)
+    try:
+        render_watermarked_file(watermarked_file)
+    except (AdmissionBusy, AdmissionTimeout) as exc:
+        # Other jobs hold the memory budget; back off so the job isn't
+        # claimed again on every poll while they do
+        watermarked_file.attempts += 1
+        delay = retry_delay(watermarked_file.attempts, exc)
+        logger.info('Watermark job %s deferred for %ss: %s', pk, delay, exc)
+        watermarked_file.status = 'PENDING'
+        watermarked_file.not_before = timezone.now() + timedelta(seconds=delay)
+        watermarked_file.save(update_fields=['status', 'attempts', 'not_before'])
+    except Exception as exc:
+        logger.exception('Watermark job %s failed', pk)
+        watermarked_file.status = 'FAILED'
+        watermarked_file.error = str(exc)
+        watermarked_file.save(update_fields=['status', 'error'])
+    return pk
+
+
+def init_worker():
+    mark_worker()
+    # Forked pool processes must not share the parent's database sockets
+    connections.close_all()
@@ -0,0 +1,244 @@
+import io
+import json
+import math
+import statistics
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import override_settings
+from PIL import Image
+from reportlab.pdfgen import canvas
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from core.memory import MemoryProbe
+from core.models import WatermarkTemplate
+from core.views import (process_image_watermark, process_image_watermark_quick,
+                        process_pdf_watermark, process_pdf_watermark_quick)
+
+PATHS = ('image', 'quick_image', 'pdf', 'quick_pdf', 'api_image', 'api_pdf')
+
+
+def _csv(cast):
+    return lambda value: [cast(item) for item in value.split(',') if item]
+
+
+def make_image(megapixels, image_format):
+    width = int(math.sqrt(megapixels * 1_000_000 * 4 / 3))
+    height = int(megapixels * 1_000_000 / width)
+    img = Image.radial_gradient('L').resize((width, height)).convert('RGB')
+    output = io.BytesIO()
+    img.save(output, format=image_format)
+    return output.getvalue()
+
+
+def make_pdf(pages):
+    output = io.BytesIO()
+    c = canvas.Canvas(output)
+    for number in range(pages):
+        c.drawString(72, 760, f'Benchmark page {number + 1}')
+        for line in range(40):
+            c.drawString(72, 720 - line * 16, 'Lorem ipsum dolor sit amet, consectetur adipiscing elit.')
+        c.showPage()
+    c.save()
+    return output.getvalue()
+
+
+def make_templates():
+    logo = io.BytesIO()
+    Image.new('RGBA', (400, 200), (200, 30, 30, 255)).save(logo, format='PNG')
+    return {
+        'text': WatermarkTemplate(name='bench-text', type='TEXT', text='CONFIDENTIAL'),
+        'image': WatermarkTemplate(name='bench-image', type='IMAGE',
+                                   image=ContentFile(logo.getvalue(), name='bench.png')),
+    }
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark every watermark path on synthetic images and PDFs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--paths', type=_csv(str), default=list(PATHS),
+                            help=f'Comma separated subset of {",".join(PATHS)}')
+        parser.add_argument('--megapixels', type=_csv(float), default=[1, 12, 50, 100],
+                            help='Image sizes in megapixels')
+        parser.add_argument('--image-formats', type=_csv(str), default=['JPEG', 'PNG'])
+        parser.add_argument('--pages', type=_csv(int), default=[1, 100, 2000],
+                            help='PDF page counts')
+        parser.add_argument('--templates', type=_csv(str), default=['text', 'image'])
+        parser.add_argument('--repeat', type=int, default=3, help='Timed runs per case')
+        parser.add_argument('--json', dest='json_output', help='Write results as JSON to this file')
+        parser.add_argument('--baseline', help='Compare against results saved with --json')
+        parser.add_argument('--threshold', type=float, default=10.0,
+                            help='Percent p50 slowdown against the baseline reported as a regression')
+
+    def handle(self, *args, **options):
+        unknown = set(options['paths']) - set(PATHS)
+        if unknown:
+            raise CommandError(f'Unknown paths: {", ".join(sorted(unknown))}')
+
+        templates = make_templates()
+        results = []
+        for case, run in self.cases(options, templates):
+            results.append(self.measure(case, run, options['repeat']))
+            self.report(results[-1])
+
+        if options['json_output']:
+            with open(options['json_output'], 'w') as fh:
+                json.dump(results, fh, indent=2)
+            self.stdout.write(f'Wrote {len(results)} results to {options["json_output"]}')
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['threshold'])
+
+    def cases(self, options, templates):
+        paths = options['paths']
+        for megapixels in options['megapixels']:
+            for image_format in options['image_formats']:
+                if not {'image', 'quick_image', 'api_image'} & set(paths):
+                    break
+                data = make_image(megapixels, image_format)
+                name = f'bench.{image_format.lower()}'
+                units = megapixels
+                for template_name in options['templates']:
+                    template = templates[template_name]
+                    case = {'input': f'{megapixels:g}MP {image_format}', 'template': template_name,
+                            'units': units, 'unit': 'MP', 'input_size': len(data)}
+                    if 'image' in paths:
+                        yield dict(case, path='image'), lambda t=template, d=data: process_image_watermark(
+                            io.BytesIO(d), t, 0, 0, 0.5, 0)
+                    if 'quick_image' in paths:
+                        yield dict(case, path='quick_image'), self.quick(
+                            process_image_watermark_quick, name, data, template)
+                    if 'api_image' in paths:
+                        yield dict(case, path='api_image'), self.api(name, data, 'IMAGE', template)
+
+        for pages in options['pages']:
+            if not {'pdf', 'quick_pdf', 'api_pdf'} & set(paths):
+                break
+            data = make_pdf(pages)
+            for template_name in options['templates']:
+                template = templates[template_name]
+                case = {'input': f'{pages} page PDF', 'template': template_name,
+                        'units': pages, 'unit': 'pages', 'input_size': len(data)}
+                if 'pdf' in paths:
+                    yield dict(case, path='pdf'), lambda t=template, d=data: process_pdf_watermark(
+                        ContentFile(d, name='bench.pdf'), t, 0, 0, 0.5, 0)
+                if 'quick_pdf' in paths:
+                    yield dict(case, path='quick_pdf'), self.quick(
+                        process_pdf_watermark_quick, 'bench.pdf', data, template)
+                if 'api_pdf' in paths:
+                    yield dict(case, path='api_pdf'), self.api('bench.pdf', data, 'PDF', template)
+
+    def quick(self, process, name, data, template):
+        def run():
+            watermark_image = None
+            if template.type == 'IMAGE':
+                template.image.seek(0)
+                watermark_image = ContentFile(template.image.read(), name='bench.png')
+            return process(ContentFile(data, name=name), template.text, watermark_image, 0, 0, 0.5, 0)
+        return run
+
+    def api(self, name, data, file_type, template):
+        from api.views import WatermarkedFileList
+
+        factory = APIRequestFactory()
+        view = WatermarkedFileList.as_view()
+
+        def run():
+            # Exercise the full API create path, rendering inline, then throw
+            # away every row and stored file it produced.
+            with tempfile.TemporaryDirectory() as media_root, \
+                    override_settings(MEDIA_ROOT=media_root, WATERMARK_BACKGROUND_JOBS=False), \
+                    transaction.atomic():
+                user = User.objects.create(username=f'bench-{time.monotonic_ns()}')
+                saved_template = WatermarkTemplate(name=template.name, type=template.type,
+                                                   text=template.text, user=user)
+                if template.type == 'IMAGE':
+                    template.image.seek(0)
+                    saved_template.image = ContentFile(template.image.read(), name='bench.png')
+                saved_template.save()
+                request = factory.post('/api/files/', {
+                    'original_file': SimpleUploadedFile(name, data),
+                    'file_type': file_type,
+                    'watermark_template': saved_template.pk,
+                    'opacity': 0.5,
+                }, format='multipart')
+                force_authenticate(request, user=user)
+                response = view(request)
+                if response.status_code != 201:
+                    raise CommandError(f'API call failed: {response.status_code} {response.data}')
+                watermarked_file = saved_template.watermarkedfile_set.get()
+                if watermarked_file.status != 'DONE':
+                    raise CommandError(f'Rendering failed: {watermarked_file.error}')
+                size = watermarked_file.watermarked_file.size
+                transaction.set_rollback(True)
+            return size
+        return run
+
+    def measure(self, case, run, repeat):
+        latencies = []
+        high_water = 0
+        output_size = None
+        run()  # warm-up, also fills the per-process caches
+        for _ in range(repeat):
+            with MemoryProbe(case['path']) as probe:
+                started = time.perf_counter()
+                result = run()
+                latencies.append(time.perf_counter() - started)
+            high_water = max(high_water, probe.high_water or 0)
+            output_size = result if isinstance(result, int) else result.size
+        p50 = statistics.median(latencies)
+        return dict(
+            case,
+            runs=repeat,
+            p50=p50,
+            p95=percentile(latencies, 0.95),
+            throughput=case['units'] / p50 if p50 else None,
+            # Growth of the high-water mark during a run, not the process's peak RSS
+            high_water_delta=high_water,
+            output_size=output_size,
+        )
+
+    def report(self, result):
+        self.stdout.write(
+            f'{result["path"]:<12} {result["input"]:<16} {result["template"]:<6} '
+            f'p50 {result["p50"] * 1000:9.1f} ms  p95 {result["p95"] * 1000:9.1f} ms  '
+            f'{result["throughput"]:8.1f} {result["unit"]}/s  '
+            f'mem +{result["high_water_delta"] / 1e6:8.1f} MB  out {result["output_size"] / 1e6:8.2f} MB'
+        )
+
+    def compare(self, results, baseline_path, threshold):
+        with open(baseline_path) as fh:
+            baseline = {
+                (item['path'], item['input'], item['template']): item for item in json.load(fh)
+            }
+        self.stdout.write(f'Comparison against {baseline_path}:')
+        regressions = 0
+        for result in results:
+            previous = baseline.get((result['path'], result['input'], result['template']))
+            if previous is None:
+                continue
+            change = (result['p50'] - previous['p50']) / previous['p50'] * 100
+            # Baselines written before the rename call the same figure peak_rss
+            previous_memory = previous.get('high_water_delta', previous.get('peak_rss', 0))
+            memory = result['high_water_delta'] - previous_memory
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            self.stdout.write(
+                f'{result["path"]:<12} {result["input"]:<16} {result["template"]:<6} '
+                f'p50 {change:+6.1f}%  mem {memory / 1e6:+8.1f} MB{flag}'
+            )
+        if regressions:
+            self.stdout.write(self.style.WARNING(f'{regressions} case(s) slower than the {threshold:g}% threshold'))
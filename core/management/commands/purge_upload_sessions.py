@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from core.uploads import purge_stale_sessions
+
+
+class Command(BaseCommand):
+    help = 'Delete chunked upload sessions, and their data, that have been idle too long'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=None,
+                            help='Idle seconds before a session is purged (defaults to WATERMARK_UPLOAD_SESSION_TTL)')
+
+    def handle(self, *args, **options):
+        count = purge_stale_sessions(options['max_age'])
+        self.stdout.write(f'Purged {count} upload session(s)')
@@ -0,0 +1,51 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from core import jobs
+
+
+class Command(BaseCommand):
+    help = 'Process pending watermark jobs with a local process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of worker processes (defaults to WATERMARK_WORKERS or CPU count)')
+        parser.add_argument('--poll-interval', type=float, default=None,
+                            help='Seconds to wait between queue polls when idle')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue has been drained')
+        parser.add_argument('--requeue-interrupted', action='store_true',
+                            help='Reset jobs left in PROCESSING by a previous worker before starting')
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or getattr(settings, 'WATERMARK_WORKERS', None) or os.cpu_count()
+        poll_interval = options['poll_interval'] or getattr(settings, 'WATERMARK_WORKER_POLL_INTERVAL', 1.0)
+
+        if options['requeue_interrupted']:
+            count = jobs.requeue_interrupted()
+            self.stdout.write(f'Requeued {count} interrupted job(s)')
+
+        self.stdout.write(f'Starting watermark worker with {workers} process(es)')
+        connections.close_all()
+        running = set()
+        with ProcessPoolExecutor(max_workers=workers, initializer=jobs.init_worker) as pool:
+            while True:
+                free = workers - len(running)
+                if free > 0:
+                    for pk in jobs.claim_jobs(free):
+                        running.add(pool.submit(jobs.run_job, pk))
+
+                if not running:
+                    if options['once']:
+                        break
+                    time.sleep(poll_interval)
+                    continue
+
+                done, running = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.stdout.write(f'Finished job {future.result()}')
@@ -0,0 +1,91 @@
+import functools
+import logging
+import resource
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+# VmHWM is one counter per process, so only one probe may reset and read it at a time
+_probe_lock = threading.Lock()
+
+
+def _status_bytes(field):
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_high_water():
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _max_rss():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class MemoryProbe:
+    """Measure how far a block of code pushes the process memory high-water mark.
+
+    On Linux the kernel's VmHWM counter is reset on entry so ``high_water`` is
+    the peak reached inside the block; elsewhere it falls back to the growth of
+    ru_maxrss, which only reports new process-wide peaks. Pillow's pixel
+    buffers are included, which tracemalloc would miss.
+
+    The counter is process wide: only one probe measures at a time, and one
+    entered while another is active, nested or in another thread (e.g. the
+    async render executor), leaves ``high_water`` as None rather than reset
+    the counter under it. Memory used meanwhile by threads that are not
+    probed is still attributed to the block, so figures are only exact on
+    single-threaded paths such as bench_watermark and the job workers.
+    """
+
+    def __init__(self, label=''):
+        self.label = label
+        self.high_water = None
+
+    def __enter__(self):
+        self._owner = _probe_lock.acquire(blocking=False)
+        if not self._owner:
+            return self
+        self._reset = _reset_high_water()
+        if self._reset:
+            self._baseline = _status_bytes('VmRSS')
+        else:
+            self._baseline = _max_rss()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self._owner:
+            return False
+        try:
+            peak = _status_bytes('VmHWM') if self._reset else _max_rss()
+            if peak is not None and self._baseline is not None:
+                self.high_water = max(peak - self._baseline, 0)
+                logger.debug('%s memory high-water: %d bytes', self.label, self.high_water)
+        finally:
+            _probe_lock.release()
+        return False
+
+
+def track_high_water(func):
+    """Record a MemoryProbe around ``func`` on its result as ``memory_high_water``."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with MemoryProbe(func.__name__) as probe:
+            result = func(*args, **kwargs)
+        result.memory_high_water = probe.high_water
+        return result
+    return wrapper
@@ -0,0 +1,217 @@
+import contextvars
+import ipaddress
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from django.conf import settings
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = tuple(2 ** power for power in range(20, 33, 2))  # 1 MiB to 4 GiB
+
+METRICS = {
+    'watermark_stage_seconds': ('Time spent in each watermarking stage', SECONDS_BUCKETS),
+    'watermark_job_seconds': ('Total time of a watermarking job', SECONDS_BUCKETS),
+    'watermark_job_tracemalloc_peak_bytes': (
+        'Peak Python heap allocation of a watermarking job (tracemalloc)', BYTES_BUCKETS),
+}
+
+_active = contextvars.ContextVar('watermark_timings', default=())
+_in_job = contextvars.ContextVar('watermark_in_job', default=False)
+
+
+class Timings:
+    """Seconds spent per named stage, summed over repeated stages."""
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def server_timing(self):
+        return ', '.join(f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.stages.items())
+
+
+class Registry:
+    """In-process histograms, optionally shared through WATERMARK_METRICS_DIR.
+
+    Each process keeps its own counts. With a metrics directory configured,
+    every process also writes a snapshot there after each job and the
+    exposition merges all snapshots, so workers show up next to the web
+    processes, similar to prometheus_client's multiprocess mode.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, metric, labels, value):
+        buckets = METRICS[metric][1]
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            counts, total, count = self._series.get(key, ([0] * len(buckets), 0.0, 0))
+            counts = [c + (value <= bound) for c, bound in zip(counts, buckets)]
+            self._series[key] = (counts, total + value, count + 1)
+
+    def snapshot(self):
+        with self._lock:
+            return [[metric, list(labels), counts, total, count]
+                    for (metric, labels), (counts, total, count) in self._series.items()]
+
+    def flush(self):
+        directory = metrics_dir()
+        if not directory:
+            return
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as fh:
+            json.dump(self.snapshot(), fh)
+        os.replace(path + '.tmp', path)
+
+    def collect(self):
+        snapshots = [self.snapshot()]
+        directory = metrics_dir()
+        if directory and os.path.isdir(directory):
+            own = f'{os.getpid()}.json'
+            for name in os.listdir(directory):
+                if name.endswith('.json') and name != own:
+                    try:
+                        with open(os.path.join(directory, name)) as fh:
+                            snapshots.append(json.load(fh))
+                    except (OSError, ValueError):
+                        continue
+        merged = {}
+        for snapshot in snapshots:
+            for metric, labels, counts, total, count in snapshot:
+                if metric not in METRICS:
+                    continue
+                key = (metric, tuple(tuple(label) for label in labels))
+                if key in merged:
+                    previous = merged[key]
+                    counts = [a + b for a, b in zip(previous[0], counts)]
+                    total, count = previous[1] + total, previous[2] + count
+                merged[key] = (counts, total, count)
+        return merged
+
+    def exposition(self):
+        """Render every histogram in the Prometheus text format."""
+        merged = self.collect()
+        lines = []
+        for metric, (help_text, buckets) in METRICS.items():
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} histogram')
+            for (name, labels), (counts, total, count) in sorted(merged.items()):
+                if name != metric:
+                    continue
+                label_text = ','.join(f'{key}="{value}"' for key, value in labels)
+                prefix = label_text + ',' if label_text else ''
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append(f'{metric}_bucket{{{prefix}le="{bound}"}} {bucket_count}')
+                lines.append(f'{metric}_bucket{{{prefix}le="+Inf"}} {count}')
+                lines.append(f'{metric}_sum{{{label_text}}} {total}')
+                lines.append(f'{metric}_count{{{label_text}}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+# tracemalloc's peak is process wide, see job()
+_trace_lock = threading.Lock()
+
+
+def metrics_dir():
+    return getattr(settings, 'WATERMARK_METRICS_DIR', None)
+
+
+def metrics_allowed(request):
+    """Whether ``request`` may read /metrics/: staff users and WATERMARK_METRICS_ALLOWED_IPS.
+
+    REMOTE_ADDR is the proxy's address behind a reverse proxy, so either
+    allow the scraper's network there or only route /metrics/ internally.
+    """
+    if request.user.is_authenticated and request.user.is_staff:
+        return True
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    networks = getattr(settings, 'WATERMARK_METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+    return any(address in ipaddress.ip_network(network, strict=False) for network in networks)
+
+
+def tracemalloc_enabled():
+    return getattr(settings, 'WATERMARK_TRACEMALLOC', False)
+
+
+@contextmanager
+def collect():
+    """Collect the stages run inside the block, e.g. for one request."""
+    timings = Timings()
+    token = _active.set(_active.get() + (timings,))
+    try:
+        yield timings
+    finally:
+        _active.reset(token)
+
+
+@contextmanager
+def stage(name):
+    """Time a named stage for every enclosing collect() and job()."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        for timings in _active.get():
+            timings.add(name, elapsed)
+
+
+@contextmanager
+def job(file_type, template_type):
+    """Instrument one watermarking job.
+
+    Stage totals are recorded in the histograms labelled with the file and
+    template type and the outcome ('ok' or 'error'); a job nested in another
+    job is folded into the outer one.
+    With WATERMARK_TRACEMALLOC enabled the job's peak Python heap usage is
+    recorded as well; tracemalloc slows allocation down noticeably and does
+    not see Pillow's pixel buffers, so it is off by default. Its peak is
+    process wide, so only one job at a time is traced.
+    """
+    if _in_job.get():
+        # Nested inside a job that already records, e.g. process_* called by
+        # render_watermarked_file; the outer job accounts for these stages.
+        yield None
+        return
+
+    labels = {'file_type': file_type, 'template_type': template_type or 'NONE'}
+    # A job running alongside a traced one would reset its peak
+    trace = tracemalloc_enabled() and _trace_lock.acquire(blocking=False)
+    if trace:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    token = _in_job.set(True)
+    timings = Timings()
+    outcome = 'error'
+    try:
+        with collect() as timings:
+            yield timings
+        outcome = 'ok'
+    finally:
+        _in_job.reset(token)
+        # Failed jobs are recorded too, so error latency and counts show up
+        labels['outcome'] = outcome
+        registry.observe('watermark_job_seconds', labels, time.perf_counter() - started)
+        for name, seconds in timings.stages.items():
+            registry.observe('watermark_stage_seconds', dict(labels, stage=name), seconds)
+        if trace:
+            peak = max(tracemalloc.get_traced_memory()[1] - baseline, 0)
+            _trace_lock.release()
+            registry.observe('watermark_job_tracemalloc_peak_bytes', labels, peak)
+        registry.flush()
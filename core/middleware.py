@@ -0,0 +1,43 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from .metrics import collect
+
+
+class ServerTimingMiddleware:
+    """Report the watermarking stages a request ran in a Server-Timing header.
+
+    Streaming responses do their work after the headers are sent, so only
+    the stages run before the view returned are included.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # Stay async under ASGI so async views are not pushed onto a thread
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        with collect() as timings:
+            response = self.get_response(request)
+        return self._add_header(response, timings, started)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        with collect() as timings:
+            response = await self.get_response(request)
+        return self._add_header(response, timings, started)
+
+    @staticmethod
+    def _add_header(response, timings, started):
+        if timings.stages:
+            total = (time.perf_counter() - started) * 1000
+            response['Server-Timing'] = f'{timings.server_timing()}, total;dur={total:.1f}'
+        return response
@@ -0,0 +1,34 @@
+# Generated by Django 5.1 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_watermarktemplate_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='watermarkedfile',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        # Rows created before the job queue existed were processed inline.
+        migrations.AddField(
+            model_name='watermarkedfile',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('PROCESSING', 'Processing'), ('DONE', 'Done'), ('FAILED', 'Failed')], db_index=True, default='DONE', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='watermarkedfile',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('PROCESSING', 'Processing'), ('DONE', 'Done'), ('FAILED', 'Failed')], db_index=True, default='PENDING', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='watermarkedfile',
+            name='watermarked_file',
+            field=models.FileField(blank=True, upload_to='watermarked_files/'),
+        ),
+    ]
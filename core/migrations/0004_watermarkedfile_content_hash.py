@@ -0,0 +1,23 @@
+# Generated by Django 5.1 on 2026-10-18 18:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_watermarkedfile_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='watermarkedfile',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='watermarkedfile',
+            name='render_key',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
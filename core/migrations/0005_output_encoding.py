@@ -0,0 +1,54 @@
+# Generated by Django 5.1 on 2026-10-18 18:10
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_watermarkedfile_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='watermarksettings',
+            name='jpeg_quality',
+            field=models.PositiveSmallIntegerField(default=85, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(100)]),
+        ),
+        migrations.AddField(
+            model_name='watermarksettings',
+            name='keep_metadata',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='watermarksettings',
+            name='optimize',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='watermarksettings',
+            name='output_format',
+            field=models.CharField(choices=[('ORIGINAL', 'Same as original'), ('JPEG', 'JPEG'), ('WEBP', 'WebP'), ('PNG', 'PNG')], default='ORIGINAL', max_length=8),
+        ),
+        migrations.AddField(
+            model_name='watermarksettings',
+            name='png_compress_level',
+            field=models.PositiveSmallIntegerField(default=6, validators=[django.core.validators.MaxValueValidator(9)]),
+        ),
+        migrations.AddField(
+            model_name='watermarksettings',
+            name='webp_quality',
+            field=models.PositiveSmallIntegerField(default=80, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(100)]),
+        ),
+        migrations.AddField(
+            model_name='watermarktemplate',
+            name='output_format',
+            field=models.CharField(blank=True, choices=[('ORIGINAL', 'Same as original'), ('JPEG', 'JPEG'), ('WEBP', 'WebP'), ('PNG', 'PNG')], max_length=8),
+        ),
+        migrations.AddField(
+            model_name='watermarktemplate',
+            name='quality',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(100)]),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1 on 2026-10-18 18:30
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_output_encoding'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='watermarkedfile',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='core_file_user_created'),
+        ),
+        migrations.AddIndex(
+            model_name='watermarktemplate',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='core_template_user_created'),
+        ),
+    ]
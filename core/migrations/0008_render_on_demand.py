@@ -0,0 +1,28 @@
+# Generated by Django 5.1 on 2026-10-18 18:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='watermarkedfile',
+            name='last_accessed',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='watermarkedfile',
+            name='output_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='watermarkedfile',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('PROCESSING', 'Processing'), ('DONE', 'Done'), ('FAILED', 'Failed'), ('RECIPE', 'Rendered on download')], db_index=True, default='PENDING', max_length=10),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-18 18:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_render_on_demand'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='watermarkedfile',
+            name='derivatives',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1 on 2026-10-18 19:00
+
+from django.db import migrations, models
+
+
+def resolve_output_options(apps, schema_editor):
+    from core.encoding import recipe_options
+
+    WatermarkedFile = apps.get_model('core', 'WatermarkedFile')
+    WatermarkSettings = apps.get_model('core', 'WatermarkSettings')
+    user_settings = {settings.user_id: settings for settings in WatermarkSettings.objects.all()}
+    for watermarked_file in WatermarkedFile.objects.select_related('watermark_template').iterator():
+        watermarked_file.output_options = recipe_options(
+            watermarked_file.file_type, watermarked_file.watermark_template,
+            user_settings.get(watermarked_file.user_id)
+        )
+        watermarked_file.save(update_fields=['output_options'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_watermarkedfile_derivatives'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='watermarkedfile',
+            name='output_options',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.RunPython(resolve_output_options, migrations.RunPython.noop),
+    ]
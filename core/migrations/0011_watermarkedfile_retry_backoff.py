@@ -0,0 +1,23 @@
+# Generated by Django 5.1 on 2026-10-18 19:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_watermarkedfile_output_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='watermarkedfile',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='watermarkedfile',
+            name='not_before',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
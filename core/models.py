@@ -1,5 +1,11 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth.models import User
+from django.core.validators import MaxValueValidator, MinValueValidator
+from .encoding import OUTPUT_FORMAT_CHOICES
+from .overlays import overlay_cache
+from .storage import compute_render_key, store_content_addressed
 
 class WatermarkTemplate(models.Model):
     WATERMARK_TYPE_CHOICES = [
@@ -11,21 +17,63 @@ class WatermarkTemplate(models.Model):
     type = models.CharField(max_length=5, choices=WATERMARK_TYPE_CHOICES)
     text = models.CharField(max_length=200, blank=True, null=True)
     image = models.ImageField(upload_to='watermark_templates/', blank=True, null=True)
+    # Optional encoder overrides for image outputs, blank falls back to WatermarkSettings
+    output_format = models.CharField(max_length=8, choices=OUTPUT_FORMAT_CHOICES, blank=True)
+    quality = models.PositiveSmallIntegerField(
+        blank=True, null=True, validators=[MinValueValidator(1), MaxValueValidator(100)]
+    )
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at', 'id'], name='core_template_user_created'),
+        ]
     
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        if self.pk is not None:
+            overlay_cache.invalidate(self.pk)
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        overlay_cache.invalidate(self.pk)
+        return super().delete(*args, **kwargs)
+
 class WatermarkedFile(models.Model):
     FILE_TYPE_CHOICES = [
         ('PDF', 'PDF Document'),
         ('IMAGE', 'Image File')
     ]
+    STATUS_CHOICES = [
+        ('PENDING', 'Pending'),
+        ('PROCESSING', 'Processing'),
+        ('DONE', 'Done'),
+        ('FAILED', 'Failed'),
+        ('RECIPE', 'Rendered on download')
+    ]
     
     original_file = models.FileField(upload_to='original_files/')
-    watermarked_file = models.FileField(upload_to='watermarked_files/')
+    watermarked_file = models.FileField(upload_to='watermarked_files/', blank=True)
     file_type = models.CharField(max_length=5, choices=FILE_TYPE_CHOICES)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING', db_index=True)
+    error = models.TextField(blank=True)
+    # SHA-256 of the original upload and of the full render recipe, see core.storage
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    render_key = models.CharField(max_length=64, blank=True, db_index=True)
+    # Set on outputs rendered on demand, which count towards WATERMARK_RESULT_CACHE_BYTES
+    output_size = models.BigIntegerField(null=True, blank=True)
+    last_accessed = models.DateTimeField(null=True, blank=True, db_index=True)
+    # Sized variants of an image output by name, see core.derivatives
+    derivatives = models.JSONField(default=dict, blank=True)
+    # Encoder options of the recipe, see core.encoding.recipe_options
+    output_options = models.JSONField(default=dict, blank=True)
+    # Deferred PENDING jobs are not claimed before not_before, see core.jobs
+    attempts = models.PositiveIntegerField(default=0)
+    not_before = models.DateTimeField(null=True, blank=True)
     watermark_template = models.ForeignKey(WatermarkTemplate, on_delete=models.SET_NULL, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -35,10 +83,28 @@ class WatermarkedFile(models.Model):
     position_y = models.IntegerField(default=0)
     opacity = models.FloatField(default=0.5)
     rotation = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at', 'id'], name='core_file_user_created'),
+        ]
     
     def __str__(self):
         return f"{self.user.username}'s {self.file_type} - {self.created_at}"
 
+    def update_render_key(self):
+        self.render_key = compute_render_key(
+            self.content_hash, self.watermark_template, self.position_x,
+            self.position_y, self.opacity, self.rotation, self.output_options
+        )
+        return self.render_key
+
+    def save(self, *args, **kwargs):
+        if self.original_file and not self.original_file._committed:
+            self.content_hash = store_content_addressed(self.original_file, 'original_files')
+        self.update_render_key()
+        super().save(*args, **kwargs)
+
 class WatermarkSettings(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     default_opacity = models.FloatField(default=0.5)
@@ -46,5 +112,33 @@ class WatermarkSettings(models.Model):
     default_position_y = models.IntegerField(default=0)
     default_rotation = models.IntegerField(default=0)
     
+    # Image output encoding
+    output_format = models.CharField(max_length=8, choices=OUTPUT_FORMAT_CHOICES, default='ORIGINAL')
+    jpeg_quality = models.PositiveSmallIntegerField(
+        default=85, validators=[MinValueValidator(1), MaxValueValidator(100)]
+    )
+    webp_quality = models.PositiveSmallIntegerField(
+        default=80, validators=[MinValueValidator(1), MaxValueValidator(100)]
+    )
+    png_compress_level = models.PositiveSmallIntegerField(
+        default=6, validators=[MaxValueValidator(9)]
+    )
+    optimize = models.BooleanField(default=False)
+    keep_metadata = models.BooleanField(default=True)
+    
     def __str__(self):
         return f"{self.user.username}'s settings"
+
+class UploadSession(models.Model):
+    """A chunked upload in progress, see core.uploads."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    # Bytes received so far; the next chunk has to start here
+    offset = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.size})"
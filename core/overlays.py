@@ -0,0 +1,217 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from PIL import Image
+
+
+def overlay_cache_dir():
+    return getattr(settings, 'WATERMARK_OVERLAY_CACHE_DIR', None)
+
+
+def overlay_cache_dir_bytes():
+    return getattr(settings, 'WATERMARK_OVERLAY_CACHE_DIR_BYTES', 256 * 1024 * 1024)
+
+
+class OverlayCache:
+    """Two-tier cache of prepared IMAGE template overlays.
+
+    Entries live in an in-process LRU bounded by pixel buffer size, backed by
+    PNG files under WATERMARK_OVERLAY_CACHE_DIR that survive restarts and are
+    shared between the web server and the worker processes. The files are
+    kept within WATERMARK_OVERLAY_CACHE_DIR_BYTES, least recently used first
+    out, going by modification time. Keys start with the template id so all
+    of a template's entries can be dropped at once.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cost(image):
+        return image.width * image.height * len(image.getbands())
+
+    @staticmethod
+    def _path(key):
+        directory = overlay_cache_dir()
+        if not directory:
+            return None
+        digest = hashlib.sha1(repr(key[1:]).encode('utf-8')).hexdigest()
+        return os.path.join(directory, str(key[0]), f'{digest}.png')
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            image = self._entries.get(key)
+            if image is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return image
+
+        path = self._path(key)
+        image = self._load(path) if path else None
+        if image is not None:
+            with self._lock:
+                self.disk_hits += 1
+            self._touch(path)
+        else:
+            with self._lock:
+                self.misses += 1
+            image = render()
+            if path and self._store(path, image):
+                self._prune(overlay_cache_dir(), overlay_cache_dir_bytes())
+        self._remember(key, image)
+        return image
+
+    def _remember(self, key, image):
+        cost = self._cost(image)
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = image
+                self.current_bytes += cost
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= self._cost(evicted)
+
+    @staticmethod
+    def _load(path):
+        try:
+            with Image.open(path) as image:
+                image.load()
+                return image
+        except (OSError, SyntaxError):
+            return None
+
+    @staticmethod
+    def _store(path, image):
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # Write then rename so other processes never read a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fh:
+                image.save(fh, format='PNG', compress_level=1)
+            os.replace(tmp_path, path)
+        except OSError:
+            return False
+        return True
+
+    @staticmethod
+    def _touch(path):
+        # The modification time doubles as the last use for _prune
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _prune(directory, max_bytes):
+        """Delete the least recently used files until the disk tier fits ``max_bytes``."""
+        if max_bytes is None:
+            return
+        files = []
+        for root, _, names in os.walk(directory):
+            for name in names:
+                if not name.endswith('.png'):
+                    # Including files other processes are still writing
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another process pruned it first
+                pass
+            except OSError:
+                continue
+            total -= size
+
+    def invalidate(self, template_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == template_id]:
+                self.current_bytes -= self._cost(self._entries.pop(key))
+        directory = overlay_cache_dir()
+        if directory:
+            shutil.rmtree(os.path.join(directory, str(template_id)), ignore_errors=True)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+            }
+
+
+overlay_cache = OverlayCache(getattr(settings, 'WATERMARK_OVERLAY_CACHE_BYTES', 64 * 1024 * 1024))
+
+
+def _cached(watermark_template, key, render):
+    # Unsaved templates have no stable identity to key on
+    if watermark_template.pk is None:
+        return render()
+    updated_at = watermark_template.updated_at
+    version = (updated_at.isoformat() if updated_at else None, watermark_template.image.name)
+    return overlay_cache.get_or_render((watermark_template.pk, version, *key), render)
+
+
+def template_image(watermark_template):
+    """The template's image decoded to RGBA. Callers must not modify it."""
+    def render():
+        with watermark_template.image.open('rb') as fh, Image.open(fh) as image:
+            return image.convert('RGBA')
+
+    return _cached(watermark_template, ('source',), render)
+
+
+def scatter_overlay(watermark_template, size, opacity):
+    """The template's image resized to ``size`` at ``opacity``, ready to paste."""
+    def render():
+        overlay = template_image(watermark_template).resize(size)
+        overlay.putalpha(int(255 * opacity))
+        return overlay
+
+    return _cached(watermark_template, ('scatter', tuple(size), opacity), render)
+
+
+def warm_template(watermark_template, opacity=0.5):
+    """Prepare a new IMAGE template's overlays ahead of its first job.
+
+    The decoded image is always cached; overlays are also prepared for every
+    target image size in WATERMARK_OVERLAY_WARM_SIZES.
+    """
+    if watermark_template.type != 'IMAGE' or not watermark_template.image:
+        return
+    template_image(watermark_template)
+    for width, height in getattr(settings, 'WATERMARK_OVERLAY_WARM_SIZES', ()):
+        scatter_overlay(watermark_template, (int(width * 0.2), int(height * 0.2)), opacity)
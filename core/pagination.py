@@ -0,0 +1,56 @@
+import base64
+import binascii
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import Http404
+
+
+def list_page_size():
+    return getattr(settings, 'WATERMARK_LIST_PAGE_SIZE', 20)
+
+
+def encode_cursor(obj):
+    position = f'{obj.created_at.isoformat()}|{obj.pk}'
+    return base64.urlsafe_b64encode(position.encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, pk = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii').split('|')
+        return datetime.fromisoformat(created_at), int(pk)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise Http404('Invalid cursor')
+
+
+def cursor_page(queryset, cursor=None, page_size=None):
+    """Return (objects, next_cursor) for one page of ``queryset``, newest first.
+
+    Pages continue from the (created_at, id) of the last row seen rather than
+    an offset, so with an index on (user, created_at) every page costs the
+    same however deep it is and no COUNT(*) is needed.
+    """
+    page_size = page_size or list_page_size()
+    queryset = queryset.order_by('-created_at', '-pk')
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+    objects = list(queryset[:page_size + 1])
+    if len(objects) <= page_size:
+        return objects, None
+    objects = objects[:page_size]
+    return objects, encode_cursor(objects[-1])
+
+
+class CursorPaginationMixin:
+    """Paginate a ListView with cursor_page(); adds ``next_cursor`` to the context."""
+
+    cursor_query_param = 'cursor'
+
+    def get_context_data(self, **kwargs):
+        objects, next_cursor = cursor_page(self.object_list, self.request.GET.get(self.cursor_query_param))
+        context = super().get_context_data(object_list=objects, **kwargs)
+        context['next_cursor'] = next_cursor
+        context['is_first_page'] = not self.request.GET.get(self.cursor_query_param)
+        return context
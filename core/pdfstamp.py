@@ -0,0 +1,162 @@
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+import PyPDF2
+from django.conf import settings
+from PyPDF2 import PageObject
+from PyPDF2.generic import IndirectObject, NameObject
+
+from .incremental import (RangeStamper, incremental_supported, pdf_stamper, pdf_write_mode,
+                          relocate, write_update)
+from .metrics import stage
+from .pools import discard_pool, in_worker, shared_pool
+from .streaming import local_file, map_file, spooled_output
+
+INHERITABLE_ATTRIBUTES = ('/Resources', '/MediaBox', '/CropBox', '/Rotate')
+
+
+def pdf_workers():
+    return getattr(settings, 'WATERMARK_PDF_WORKERS', None) or os.cpu_count()
+
+
+def parallel_threshold():
+    return getattr(settings, 'WATERMARK_PDF_PARALLEL_PAGES', 500)
+
+
+def chunk_pages():
+    return getattr(settings, 'WATERMARK_PDF_CHUNK_PAGES', 100)
+
+
+def page_count(reader):
+    # Read from the page tree root, without loading every page like len(reader.pages)
+    return int(reader.trailer['/Root']['/Pages']['/Count'])
+
+
+def _walk(reader, node, inherited, start, stop, first):
+    inherited = dict(inherited)
+    for key in INHERITABLE_ATTRIBUTES:
+        if key in node:
+            inherited[key] = node.raw_get(key)
+    kids = node['/Kids']
+    # When the counts add up to one page per kid, kids before the range can be
+    # skipped without parsing them
+    one_page_each = node.get('/Count') == len(kids)
+    index = first
+    for reference in kids:
+        if index >= stop:
+            return
+        if one_page_each and index < start:
+            index += 1
+            continue
+        kid = reference.get_object()
+        if '/Kids' in kid:
+            count = int(kid['/Count'])
+            if index + count > start:
+                yield from _walk(reader, kid, inherited, start, stop, index)
+            index += count
+            continue
+        if index >= start:
+            if not isinstance(reference, IndirectObject) or kid.get('/Type') != '/Page':
+                raise ValueError('Unsupported page tree')
+            page = PageObject(reader, reference)
+            page.update(kid)
+            for key, value in inherited.items():
+                if key not in page:
+                    page[NameObject(key)] = value
+            yield page
+        index += 1
+
+
+def iter_page_range(reader, start, stop):
+    """Yield the pages in [start, stop) with inherited attributes filled in.
+
+    Unlike reader.pages this only parses the part of the page tree that leads
+    to the range.
+    """
+    yield from _walk(reader, reader.trailer['/Root']['/Pages'], {}, start, stop, 0)
+
+
+def stamp_range(path, index, start, stop, page_stamp):
+    """Stamp pages [start, stop) of the PDF at ``path``; runs in a pool worker."""
+    with map_file(path) as source:
+        reader = PyPDF2.PdfReader(source)
+        stamper = RangeStamper(reader, source, index)
+        count = 0
+        for page in iter_page_range(reader, start, stop):
+            stamper.add_page(page, page_stamp(page))
+            count += 1
+        return count, stamper.fragments()
+
+
+def _stamp_ranges(path, pages, page_stamp):
+    size = chunk_pages()
+    # Ranges depend only on the page count, so the output is the same
+    # whatever the number of workers
+    ranges = [(path, index, start, min(start + size, pages), page_stamp)
+              for index, start in enumerate(range(0, pages, size))]
+    # Job and batch workers already run one process per CPU, and their
+    # memory is admitted per document, so they do not fan out again
+    if pdf_workers() <= 1 or len(ranges) <= 1 or in_worker():
+        return [stamp_range(*args) for args in ranges]
+    pool = shared_pool('pdf', pdf_workers())
+    try:
+        return list(pool.map(stamp_range, *zip(*ranges)))
+    except BrokenProcessPool:
+        discard_pool('pdf', pool)
+        return [stamp_range(*args) for args in ranges]
+
+
+def _write_ranges(output, source, reader, xref_offset, results):
+    base = int(reader.trailer['/Size'])
+    objects = []
+    for _, (changed, new) in results:
+        for number, generation, fragment in changed:
+            objects.append((number, generation, relocate(fragment, base)))
+        for offset, fragment in enumerate(new):
+            objects.append((base + offset, 0, relocate(fragment, base)))
+        base += len(new)
+    write_update(output, source, reader.trailer, xref_offset, objects, base)
+
+
+def stamp_pdf(original_file, page_stamp):
+    """Draw ``page_stamp(page)`` over every page of a PDF; returns the output file.
+
+    Documents of at least WATERMARK_PDF_PARALLEL_PAGES pages that can be
+    written as an incremental update are split into WATERMARK_PDF_CHUNK_PAGES
+    page ranges stamped in the shared 'pdf' process pool, or one after the
+    other inside job and batch workers. ``page_stamp`` must be picklable for
+    that, e.g. a functools.partial of a module-level function.
+    """
+    output = spooled_output()
+    with local_file(original_file) as path, map_file(path) as source:
+        with stage('decode'):
+            pdf_reader = PyPDF2.PdfReader(source)
+            pages = page_count(pdf_reader)
+            xref_offset = None
+            if pdf_write_mode() == 'incremental' and pages >= parallel_threshold():
+                xref_offset = incremental_supported(pdf_reader, source)
+
+        results = None
+        if xref_offset is not None:
+            with stage('merge'):
+                try:
+                    results = _stamp_ranges(path, pages, page_stamp)
+                except ValueError:
+                    results = None
+            if results is not None and sum(count for count, _ in results) == pages:
+                with stage('encode'):
+                    _write_ranges(output, source, pdf_reader, xref_offset, results)
+                output.seek(0)
+                return output
+
+        stamper = pdf_stamper(pdf_reader, source)
+        for page in pdf_reader.pages:
+            with stage('render'):
+                stamp = page_stamp(page)
+            with stage('merge'):
+                stamper.add_page(page, stamp)
+
+        with stage('encode'):
+            stamper.write(output)
+    output.seek(0)
+    return output
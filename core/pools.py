@@ -0,0 +1,57 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+_pools = {}
+_pools_lock = threading.Lock()
+_in_worker = False
+
+
+def in_worker():
+    """True inside a pool process: a job worker, a batch or a PDF range worker."""
+    return _in_worker
+
+
+def mark_worker():
+    global _in_worker
+    _in_worker = True
+
+
+def _init_process():
+    # forkserver and spawn children start from a fresh interpreter
+    import django
+
+    django.setup()
+    from .jobs import init_worker
+
+    init_worker()
+
+
+def _context():
+    # Forking a web process that runs executor threads can copy held locks
+    # into the child; a forkserver forks from a clean single-threaded process
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def shared_pool(name, workers):
+    """The long-lived process pool ``name`` of this process, started on first use.
+
+    One pool per name bounds the number of processes however many requests
+    use it concurrently.
+    """
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None:
+            pool = _pools[name] = ProcessPoolExecutor(
+                max_workers=workers, mp_context=_context(), initializer=_init_process)
+        return pool
+
+
+def discard_pool(name, pool):
+    """Forget ``pool`` after it broke, so the next shared_pool() call starts a new one."""
+    with _pools_lock:
+        if _pools.get(name) is pool:
+            del _pools[name]
+    pool.shutdown(wait=False, cancel_futures=True)
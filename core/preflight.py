@@ -0,0 +1,138 @@
+import logging
+from collections import namedtuple
+
+import PyPDF2
+from PIL import Image, UnidentifiedImageError
+
+try:
+    import magic
+except ImportError:  # python-magic (or libmagic) is optional, see sniff_content_type
+    magic = None
+
+logger = logging.getLogger(__name__)
+
+HEADER_BYTES = 2048
+
+# Leading bytes of the formats we can tell apart without libmagic
+SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+    (b'BM', 'image/bmp'),
+    (b'PK\x03\x04', 'application/zip'),
+]
+
+# What an upload is, read from its first bytes and headers only. Image fields
+# are None for PDFs and the PDF fields for images.
+Preflight = namedtuple('Preflight', ['content_type', 'file_type', 'format', 'width', 'height', 'mode',
+                                     'pages', 'page_size', 'size'])
+
+
+class UnsupportedFile(ValueError):
+    pass
+
+
+def _signature_type(head):
+    # PDF readers accept junk before the header, within the first kilobyte
+    if b'%PDF-' in head[:1024]:
+        return 'application/pdf'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, content_type in SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    return 'application/octet-stream'
+
+
+def sniff_content_type(head):
+    """MIME type of a file from its first bytes, ignoring its name.
+
+    Uses libmagic through python-magic when available and a small table of
+    signatures for the formats we process otherwise.
+    """
+    if magic is not None:
+        try:
+            content_type = magic.from_buffer(head, mime=True)
+        except Exception:
+            logger.warning('libmagic failed, falling back to built-in signatures', exc_info=True)
+        else:
+            # libmagic misses PDFs with leading junk and some image variants
+            if content_type not in ('application/octet-stream', 'text/plain'):
+                return content_type
+    return _signature_type(head)
+
+
+def _rewind(file):
+    if hasattr(file, 'open') and getattr(file, 'closed', False):
+        file.open('rb')
+    file.seek(0)
+
+
+def _pdf_info(file):
+    from .pdfstamp import iter_page_range, page_count
+
+    try:
+        reader = PyPDF2.PdfReader(file)
+        if reader.is_encrypted:
+            return page_count(reader), None
+        pages = page_count(reader)
+        try:
+            # Only the path to the first page is parsed, not the whole page tree
+            first = next(iter_page_range(reader, 0, 1), None)
+        except ValueError:
+            # Trees iter_page_range doesn't walk, such as pages stored inline
+            # in /Kids, are still readable by PyPDF2 the slow way
+            first = reader.pages[0] if pages else None
+    except (PyPDF2.errors.PyPdfError, KeyError, ValueError, TypeError) as exc:
+        raise UnsupportedFile(f'Unreadable PDF: {exc}')
+    page_size = (float(first.mediabox.width), float(first.mediabox.height)) if first is not None else None
+    return pages, page_size
+
+
+def preflight(file):
+    """Identify ``file`` from its header and read its metadata without decoding it.
+
+    Images are opened by Pillow, which only parses the header until pixels
+    are needed; PDFs only have their cross-reference table, catalog and first
+    page read. The result is cached on ``file`` as ``preflight_info``.
+    Raises UnsupportedFile for anything that is neither.
+    """
+    cached = getattr(file, 'preflight_info', None)
+    if cached is not None:
+        return cached
+
+    _rewind(file)
+    try:
+        head = file.read(HEADER_BYTES)
+        content_type = sniff_content_type(head)
+        size = getattr(file, 'size', None)
+        if content_type == 'application/pdf':
+            _rewind(file)
+            pages, page_size = _pdf_info(file)
+            info = Preflight(content_type, 'PDF', 'PDF', None, None, None, pages, page_size, size)
+        elif content_type.startswith('image/'):
+            _rewind(file)
+            try:
+                with Image.open(file) as img:
+                    info = Preflight(content_type, 'IMAGE', img.format, img.width, img.height, img.mode,
+                                     None, None, size)
+            except UnidentifiedImageError:
+                raise UnsupportedFile(f'Unsupported image type {content_type}')
+        else:
+            raise UnsupportedFile(f'Unsupported file type {content_type}')
+    finally:
+        _rewind(file)
+
+    try:
+        file.preflight_info = info
+    except AttributeError:
+        pass
+    return info
+
+
+def detect_file_type(file):
+    """'PDF' or 'IMAGE' from the content of ``file``, see preflight()."""
+    return preflight(file).file_type
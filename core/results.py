@@ -0,0 +1,105 @@
+import logging
+
+from django.conf import settings
+from django.db.models import Sum
+from django.utils import timezone
+
+from .admission import AdmissionError, InputTooLarge
+from .derivatives import delete_derivatives, derivatives_size
+from .jobs import render_watermarked_file
+from .models import WatermarkedFile
+
+logger = logging.getLogger(__name__)
+
+
+def result_cache_bytes():
+    return getattr(settings, 'WATERMARK_RESULT_CACHE_BYTES', None)
+
+
+def _siblings(watermarked_file):
+    # Rows with the same render key share one stored output, see reuse_cached_result
+    if watermarked_file.render_key:
+        return WatermarkedFile.objects.filter(render_key=watermarked_file.render_key)
+    return WatermarkedFile.objects.filter(pk=watermarked_file.pk)
+
+
+def ensure_rendered(watermarked_file):
+    """Make sure the output of ``watermarked_file`` exists, rendering it if needed.
+
+    Returns True once the output can be served, False while another request
+    or a worker is rendering it. Outputs rendered here count towards
+    WATERMARK_RESULT_CACHE_BYTES and may later be evicted, in which case the
+    next access renders them again.
+    """
+    output = watermarked_file.watermarked_file
+    if watermarked_file.status == 'DONE':
+        if output and output.storage.exists(output.name):
+            _siblings(watermarked_file).update(last_accessed=timezone.now())
+            return True
+        # Evicted by another process since this row was loaded
+        WatermarkedFile.objects.filter(pk=watermarked_file.pk, status='DONE').update(
+            status='RECIPE', watermarked_file='', output_size=None, derivatives={})
+    elif watermarked_file.status != 'RECIPE':
+        return False
+
+    # Conditional update so concurrent downloads render it only once
+    if not WatermarkedFile.objects.filter(pk=watermarked_file.pk, status='RECIPE').update(status='PROCESSING'):
+        watermarked_file.refresh_from_db()
+        return watermarked_file.status == 'DONE'
+    watermarked_file.refresh_from_db()
+    try:
+        rendered = render_watermarked_file(watermarked_file)
+    except AdmissionError as exc:
+        if isinstance(exc, InputTooLarge):
+            watermarked_file.status = 'FAILED'
+            watermarked_file.error = str(exc)
+            watermarked_file.save(update_fields=['status', 'error'])
+        else:
+            # Not enough memory right now; the next download tries again
+            watermarked_file.status = 'RECIPE'
+            watermarked_file.save(update_fields=['status'])
+        raise
+    except Exception as exc:
+        logger.exception('On-demand render of %s failed', watermarked_file.pk)
+        watermarked_file.status = 'FAILED'
+        watermarked_file.error = str(exc)
+        watermarked_file.save(update_fields=['status', 'error'])
+        return False
+
+    if rendered:
+        watermarked_file.output_size = (
+            watermarked_file.watermarked_file.size + derivatives_size(watermarked_file.derivatives))
+        watermarked_file.save(update_fields=['output_size'])
+    _siblings(watermarked_file).update(last_accessed=timezone.now())
+    evict_results(keep=watermarked_file)
+    return True
+
+
+def evict_results(keep=None, max_bytes=None):
+    """Delete least recently downloaded on-demand outputs beyond the budget.
+
+    Rows that used an evicted output go back to RECIPE so their next access
+    renders it again. Returns the number of outputs deleted.
+    """
+    max_bytes = result_cache_bytes() if max_bytes is None else max_bytes
+    if max_bytes is None:
+        return 0
+    cached = WatermarkedFile.objects.filter(output_size__isnull=False)
+    total = cached.aggregate(total=Sum('output_size'))['total'] or 0
+    evicted = 0
+    candidates = cached.order_by('last_accessed', 'pk')
+    if keep is not None:
+        # keep may be serving another row's output through a shared render key
+        candidates = candidates.exclude(watermarked_file=keep.watermarked_file.name)
+    while total > max_bytes:
+        victim = candidates.first()
+        if victim is None:
+            break
+        name = victim.watermarked_file.name
+        _siblings(victim).filter(watermarked_file=name).update(
+            status='RECIPE', watermarked_file='', output_size=None, derivatives={})
+        victim.watermarked_file.storage.delete(name)
+        delete_derivatives(victim.watermarked_file.storage, victim.derivatives)
+        total -= victim.output_size
+        evicted += 1
+    return evicted
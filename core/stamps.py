@@ -0,0 +1,317 @@
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+import PyPDF2
+from django.conf import settings
+from PyPDF2.generic import (ArrayObject, DecodedStreamObject, DictionaryObject, IndirectObject,
+                            NameObject, RectangleObject)
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+from .overlays import template_image
+from .storage import hash_file
+
+
+class StampCache:
+    """LRU cache of parsed single-page PDF watermark overlays.
+
+    Pages of a document almost always share one mediabox, so the overlay for a
+    given (template, size, opacity, ...) combination is drawn and parsed once
+    and the resulting page object is stamped onto every page that needs it.
+    The cache is bounded by the decoded stream data the pages hold, which
+    for IMAGE templates includes the embedded image.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cost(page):
+        seen = set()
+        return sum(_resolve(page[key], seen) for key in ('/Contents', '/Resources') if key in page)
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        page = render()
+        cost = self._cost(page)
+        if cost > self.max_bytes:
+            return page
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (page, cost)
+                self.current_bytes += cost
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_cost) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_cost
+        return page
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+stamp_cache = StampCache(getattr(settings, 'WATERMARK_STAMP_CACHE_BYTES', 64 * 1024 * 1024))
+
+
+def content_hash(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def template_version(watermark_template):
+    updated_at = getattr(watermark_template, 'updated_at', None)
+    return (watermark_template.pk, updated_at.isoformat() if updated_at else None)
+
+
+def _resolve(obj, seen):
+    # Walk the overlay's contents and resources once so the owning reader has
+    # every indirect object cached; afterwards merges never touch its stream,
+    # which makes the cached page safe to share between threads. Returns the
+    # size of the decoded stream data reached.
+    obj = obj.get_object()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = 0
+    if isinstance(obj, PyPDF2.generic.StreamObject):
+        size += len(obj.get_data())
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if key != '/Parent':
+                size += _resolve(value, seen)
+    elif isinstance(obj, list):
+        for value in obj:
+            size += _resolve(value, seen)
+    return size
+
+
+def render_stamp(width, height, draw):
+    buffer = io.BytesIO()
+    c = canvas.Canvas(buffer, pagesize=(width, height))
+    draw(c)
+    c.save()
+    buffer.seek(0)
+    page = PyPDF2.PdfReader(buffer).pages[0]
+    seen = set()
+    for key in ('/Contents', '/Resources'):
+        if key in page:
+            _resolve(page[key], seen)
+    return page
+
+
+def draw_template_pattern(c, width, height, text, image, opacity):
+    c.setFillAlpha(opacity)
+    if text is not None:
+        # Create diagonal pattern
+        diagonal_spacing = min(width, height) / 4
+
+        # Draw diagonal text patterns
+        for i in range(0, int(width + height), int(diagonal_spacing)):
+            c.saveState()
+            c.translate(i, 0)
+            c.rotate(45)
+            c.drawString(0, 0, text)
+            c.restoreState()
+
+            c.saveState()
+            c.translate(i, height)
+            c.rotate(-45)
+            c.drawString(0, 0, text)
+            c.restoreState()
+    else:
+        # Create scattered pattern
+        grid_size = 4
+        img_width = 50
+        img_height = 50
+
+        for x in range(grid_size):
+            for y in range(grid_size):
+                pos_x = (width / grid_size) * x
+                pos_y = (height / grid_size) * y
+                c.drawImage(image, pos_x, pos_y, width=img_width, height=img_height, mask='auto')
+
+
+def template_digest(watermark_template):
+    """Digest of what a template draws: its text, or the bytes of its image.
+
+    The image is read once per template instance, not once per page.
+    """
+    if watermark_template.type == 'TEXT':
+        return content_hash(watermark_template.text or '')
+    name = watermark_template.image.name
+    cached = getattr(watermark_template, '_stamp_digest', None)
+    if cached is None or cached[0] != name:
+        with watermark_template.image.open('rb') as fh:
+            cached = watermark_template._stamp_digest = (name, hash_file(fh))
+    return cached[1]
+
+
+def get_template_stamp(watermark_template, width, height, opacity, rotation):
+    width, height = float(width), float(height)
+    key = ('template', template_version(watermark_template), width, height, opacity, rotation,
+           template_digest(watermark_template))
+
+    def render():
+        if watermark_template.type == 'TEXT':
+            return render_stamp(width, height, lambda c: draw_template_pattern(
+                c, width, height, watermark_template.text, None, opacity))
+        img = ImageReader(template_image(watermark_template))
+        return render_stamp(width, height, lambda c: draw_template_pattern(
+            c, width, height, None, img, opacity))
+
+    return stamp_cache.get_or_render(key, render)
+
+
+def get_quick_stamp(text, image_data, width, height, pos_x, pos_y, opacity, rotation):
+    width, height = float(width), float(height)
+    digest = content_hash(text or image_data or b'')
+    key = ('quick', width, height, pos_x, pos_y, opacity, rotation, digest)
+
+    def draw(c):
+        c.setFillAlpha(opacity)
+        c.translate(pos_x * width, pos_y * height)
+        c.rotate(rotation)
+        if text:
+            c.drawString(0, 0, text)
+        elif image_data:
+            c.drawImage(ImageReader(io.BytesIO(image_data)), 0, 0, width=100, height=100, mask='auto')
+
+    return stamp_cache.get_or_render(key, lambda: render_stamp(width, height, draw))
+
+
+def template_page_stamp(watermark_template, opacity, rotation, page):
+    return get_template_stamp(watermark_template, page.mediabox.width, page.mediabox.height, opacity, rotation)
+
+
+def quick_page_stamp(text, image_data, pos_x, pos_y, opacity, rotation, page):
+    return get_quick_stamp(text, image_data, page.mediabox.width, page.mediabox.height,
+                           pos_x, pos_y, opacity, rotation)
+
+
+class BaseStamper:
+    """Draw a stamp over pages.
+
+    Rather than copying the stamp's drawing into every page like merge_page,
+    each distinct stamp becomes one Form XObject in the output (its images
+    and fonts included) and pages only reference it, so the output grows by
+    a few bytes per page however heavy the watermark is. Subclasses decide
+    where pages and new objects go (_place, _add_object, _copy) and how the
+    result is written.
+    """
+
+    name_prefix = '/WatermarkStamp'
+
+    def __init__(self):
+        self._forms = {}
+        self._wrappers = {}
+
+    def add_page(self, page, stamp):
+        page = self._place(page)
+        name, form = self._form(stamp)
+
+        resources = self._subdictionary(page, '/Resources')
+        xobjects = self._subdictionary(resources, '/XObject')
+        while name in xobjects and xobjects[name] != form:
+            name = NameObject(name + '_')
+        xobjects[name] = form
+
+        # Isolate the page's own graphics state, then draw the stamp over it
+        box = page.mediabox
+        prefix, suffix = self._wrapper(name, box.left, box.bottom)
+        contents = page.get('/Contents')
+        if contents is None:
+            streams = []
+        elif isinstance(contents.get_object(), ArrayObject):
+            streams = list(contents.get_object())
+        else:
+            streams = [page.raw_get('/Contents')]
+        # Streams have to be indirect; some writers embed them directly
+        streams = [item if isinstance(item, IndirectObject) else self._add_object(item) for item in streams]
+        page[NameObject('/Contents')] = ArrayObject([prefix, *streams, suffix])
+        return page
+
+    def _subdictionary(self, parent, key):
+        value = parent.get(key)
+        if value is None:
+            value = parent[NameObject(key)] = DictionaryObject()
+        return value.get_object()
+
+    def _form(self, stamp):
+        # Keyed by identity; the stamp is kept alive so its id is not reused
+        if id(stamp) not in self._forms:
+            contents = stamp['/Contents'].get_object()
+            if isinstance(contents, ArrayObject):
+                form = DecodedStreamObject()
+                form.set_data(b'\n'.join(item.get_object().get_data() for item in contents))
+            else:
+                form = self._copy(contents)
+            form.update({
+                NameObject('/Type'): NameObject('/XObject'),
+                NameObject('/Subtype'): NameObject('/Form'),
+                NameObject('/BBox'): RectangleObject([0, 0, stamp.mediabox.width, stamp.mediabox.height]),
+                NameObject('/Resources'): self._copy(stamp['/Resources']),
+            })
+            name = NameObject(f'{self.name_prefix}{len(self._forms)}')
+            self._forms[id(stamp)] = (stamp, name, self._add_object(form))
+        _, name, form = self._forms[id(stamp)]
+        return name, form
+
+    def _wrapper(self, name, x, y):
+        key = (name, x, y)
+        if key not in self._wrappers:
+            refs = []
+            for data in (b'q\n', f'\nQ\nq 1 0 0 1 {x} {y} cm {name} Do Q\n'.encode()):
+                stream = DecodedStreamObject()
+                stream.set_data(data)
+                refs.append(self._add_object(stream))
+            self._wrappers[key] = tuple(refs)
+        return self._wrappers[key]
+
+
+class PageStamper(BaseStamper):
+    """Add pages to a PdfWriter with a stamp drawn over each of them."""
+
+    def __init__(self, writer):
+        super().__init__()
+        self.writer = writer
+
+    def write(self, output):
+        self.writer.write(output)
+
+    def _place(self, page):
+        return self.writer.add_page(page)
+
+    def _add_object(self, obj):
+        return self.writer._add_object(obj)
+
+    def _copy(self, obj):
+        return obj.clone(self.writer, force_duplicate=True)
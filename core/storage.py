@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+
+class HashingUploadMixin:
+    """Compute the SHA-256 of an upload while its chunks stream in.
+
+    The digest is attached to the resulting UploadedFile as ``content_hash``
+    so storing it by content never has to read the file a second time.
+    """
+
+    def new_file(self, *args, **kwargs):
+        # Set up first: the handler that takes the file raises StopFutureHandlers
+        self.hasher = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        remaining = super().receive_data_chunk(raw_data, start)
+        if remaining is None:
+            self.hasher.update(raw_data)
+        return remaining
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.content_hash = self.hasher.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadMixin, TemporaryFileUploadHandler):
+    pass
+
+
+def hash_file(file):
+    hasher = hashlib.sha256()
+    for chunk in file.chunks():
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def content_addressed_name(prefix, digest, filename):
+    extension = os.path.splitext(filename)[1].lower()
+    return f'{prefix}/{digest[:2]}/{digest}{extension}'
+
+
+def store_content_addressed(field_file, prefix):
+    """Save an uncommitted FieldFile under its digest, reusing an existing copy.
+
+    Returns the hex digest. Identical uploads therefore share one stored file
+    no matter how often they are submitted.
+    """
+    uploaded = field_file.file
+    digest = getattr(uploaded, 'content_hash', None) or hash_file(uploaded)
+    name = content_addressed_name(prefix, digest, uploaded.name)
+    if not field_file.storage.exists(name):
+        name = field_file.storage.save(name, uploaded)
+    field_file.name = name
+    field_file._committed = True
+    return digest
+
+
+def compute_render_key(content_hash, watermark_template, pos_x, pos_y, opacity, rotation, output_options):
+    """Identify a rendered output by everything that influences its bytes."""
+    if not content_hash or watermark_template is None:
+        return ''
+    updated_at = watermark_template.updated_at
+    recipe = [
+        content_hash,
+        watermark_template.pk,
+        updated_at.isoformat() if updated_at else None,
+        opacity,
+        pos_x,
+        pos_y,
+        rotation,
+        output_options,
+    ]
+    return hashlib.sha256(json.dumps(recipe, sort_keys=True).encode('utf-8')).hexdigest()
@@ -0,0 +1,61 @@
+import mmap
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+def _local_path(file):
+    temporary_file_path = getattr(file, 'temporary_file_path', None)
+    if temporary_file_path is not None:
+        return temporary_file_path()
+    try:
+        return file.path
+    except (AttributeError, NotImplementedError, ValueError):
+        return None
+
+
+@contextmanager
+def local_file(file):
+    """Yield a path on the local filesystem holding the contents of ``file``.
+
+    Uploads Django already spooled to disk and files in local storage are
+    used in place; anything else (in-memory uploads, remote storage) is
+    copied to a temporary file first.
+    """
+    path = _local_path(file)
+    if path is not None:
+        yield path
+        return
+    with tempfile.NamedTemporaryFile() as fh:
+        if hasattr(file, 'open'):
+            file.open('rb')
+        file.seek(0)
+        shutil.copyfileobj(file, fh, 1024 * 1024)
+        fh.flush()
+        yield fh.name
+
+
+@contextmanager
+def map_file(path):
+    with open(path, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        yield mapped
+
+
+@contextmanager
+def mapped_input(file):
+    """Yield a read-only memory map of ``file``, see local_file().
+
+    Pages are faulted in on demand instead of the whole document being read
+    into the heap.
+    """
+    with local_file(file) as path, map_file(path) as mapped:
+        yield mapped
+
+
+def spooled_output():
+    """A temporary file that stays in memory until WATERMARK_SPOOL_MAX_SIZE bytes."""
+    return tempfile.SpooledTemporaryFile(
+        max_size=getattr(settings, 'WATERMARK_SPOOL_MAX_SIZE', 16 * 1024 * 1024)
+    )
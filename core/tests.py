@@ -1,3 +1,867 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+import tracemalloc
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+import PyPDF2
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from PIL import Image, ImageChops, ImageDraw
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import FileResponse
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .admission import AdmissionBusy, AdmissionTimeout
+from .batch import InvalidBatch, check_uploads, iter_uploads, safe_name, stream_batch_zip
+from .compositing import composite_placements, compositing_engine, np
+from .downloads import parse_range
+from .encoding import DEFAULT_OPTIONS
+from .fonts import get_font
+from .incremental import IncrementalStamper, RangeStamper
+from .management.commands.bench_watermark import make_image, make_pdf
+from .memory import MemoryProbe
+from .metrics import _trace_lock, job, registry
+from .pagination import cursor_page
+from .results import ensure_rendered, evict_results
+from .jobs import claim_jobs, enqueue, retry_delay, run_job
+from .overlays import OverlayCache
+from .preflight import UnsupportedFile, preflight
+from .stamps import StampCache, get_template_stamp, render_stamp, template_digest
+from .models import WatermarkSettings, WatermarkTemplate, WatermarkedFile
+from .views import apply_template_watermark, process_image_watermark, process_pdf_watermark
+
+
+class MediaTestCase(TestCase):
+    """Runs each test class against its own temporary MEDIA_ROOT."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.media_root = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, cls.media_root, ignore_errors=True)
+        # Class cleanups unwind in reverse, after any class-level override_settings
+        media_override = override_settings(
+            MEDIA_ROOT=cls.media_root,
+            WATERMARK_OVERLAY_CACHE_DIR=None,
+            WATERMARK_BACKGROUND_JOBS=False,
+        )
+        media_override.enable()
+        cls.addClassCleanup(media_override.disable)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.template = WatermarkTemplate.objects.create(name='Text', type='TEXT', text='SAMPLE', user=cls.user)
+
+    def make_output(self, data):
+        watermarked_file = WatermarkedFile(
+            user=self.user, watermark_template=self.template, file_type='IMAGE', status='DONE',
+            original_file=ContentFile(make_image(0.1, 'PNG'), name='original.png'),
+        )
+        watermarked_file.watermarked_file.save('output.bin', ContentFile(data), save=False)
+        watermarked_file.save()
+        return watermarked_file
+
+
+class AsyncStreamingTests(MediaTestCase):
+    async def consume(self, response):
+        return [chunk async for chunk in response.streaming_content]
+
+    async def test_download_streams_under_asgi(self):
+        data = bytes(range(256)) * (FileResponse.block_size // 64)
+        watermarked_file = await sync_to_async(self.make_output)(data)
+        await self.async_client.aforce_login(self.user)
+
+        response = await self.async_client.get(reverse('download_watermarked_file', args=[watermarked_file.pk]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        chunks = await self.consume(response)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b''.join(chunks), data)
+
+    async def test_range_download_streams_under_asgi(self):
+        data = b'0123456789' * 1000
+        watermarked_file = await sync_to_async(self.make_output)(data)
+        await self.async_client.aforce_login(self.user)
+
+        response = await self.async_client.get(
+            reverse('download_watermarked_file', args=[watermarked_file.pk]), headers={'Range': 'bytes=10-19'})
+
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response.is_async)
+        self.assertEqual(b''.join(await self.consume(response)), data[10:20])
+
+    async def test_quick_watermark_streams_under_asgi(self):
+        await self.async_client.aforce_login(self.user)
+
+        response = await self.async_client.post(reverse('quick_watermark'), {
+            'file': ContentFile(make_image(0.1, 'PNG'), name='quick.png'),
+            'watermark_text': 'QUICK', 'position_x': 0, 'position_y': 0, 'opacity': 0.5, 'rotation': 0,
+        })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        self.assertTrue(b''.join(await self.consume(response)).startswith(b'\x89PNG'))
+
+    async def test_quick_watermark_preflights_off_the_event_loop(self):
+        await self.async_client.aforce_login(self.user)
+        loops = []
+
+        def record_loop(file):
+            try:
+                loops.append(asyncio.get_running_loop())
+            except RuntimeError:
+                loops.append(None)
+            return preflight(file)
+
+        with mock.patch('core.forms.preflight', side_effect=record_loop):
+            response = await self.async_client.post(reverse('quick_watermark'), {
+                'file': ContentFile(make_pdf(1), name='quick.png'),
+                'watermark_text': 'QUICK', 'position_x': 0, 'position_y': 0, 'opacity': 0.5, 'rotation': 0,
+            })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b''.join(await self.consume(response)).startswith(b'%PDF'))
+        self.assertEqual(loops, [None])
+
+    def test_sync_client_keeps_sync_iterator(self):
+        watermarked_file = self.make_output(b'data')
+        self.client.force_login(self.user)
+
+        response = self.client.get(reverse('download_watermarked_file', args=[watermarked_file.pk]))
+
+        self.assertFalse(response.is_async)
+        self.assertEqual(b''.join(response.streaming_content), b'data')
+
+
+class DownloadTests(MediaTestCase):
+    data = b'0123456789'
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.watermarked_file = self.make_output(self.data)
+        self.url = reverse('download_watermarked_file', args=[self.watermarked_file.pk])
+
+    def get(self, **headers):
+        return self.client.get(self.url, headers=headers)
+
+    def test_parse_range(self):
+        cases = {
+            'bytes=2-4': (2, 5), 'bytes=2-': (2, 10), 'bytes=8-20': (8, 10),
+            'bytes=-3': (7, 10), 'bytes=-20': (0, 10), 'bytes=-0': False, 'bytes=10-': False,
+            'bytes=5-2': None, 'bytes=0-1,4-5': None, 'items=0-1': None, 'bytes=-': None, '': None,
+        }
+        for header, expected in cases.items():
+            with self.subTest(header=header):
+                self.assertEqual(parse_range(header, len(self.data)), expected)
+
+    def test_suffix_range(self):
+        response = self.get(Range='bytes=-3')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 7-9/10')
+        self.assertEqual(b''.join(response.streaming_content), b'789')
+
+    def test_reversed_range_sends_the_whole_file(self):
+        response = self.get(Range='bytes=5-2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+
+    def test_unsatisfiable_range(self):
+        response = self.get(Range='bytes=10-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+
+    def test_if_range(self):
+        etag = self.get()['ETag']
+        response = self.get(Range='bytes=2-4', If_Range=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'234')
+
+        # The output changed since the client's first request: send all of it
+        response = self.get(Range='bytes=2-4', If_Range='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+
+    def test_not_modified(self):
+        etag = self.get()['ETag']
+        response = self.get(If_None_Match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    @override_settings(WATERMARK_DOWNLOAD_BACKEND='x-accel-redirect', WATERMARK_X_ACCEL_PREFIX='/internal/')
+    def test_x_accel_redirect(self):
+        response = self.get(Range='bytes=2-4')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/internal/' + self.watermarked_file.watermarked_file.name)
+        self.assertNotIn('Content-Type', response)
+        self.assertEqual(response.content, b'')
+        self.assertIn('ETag', response)
+        self.assertIn('attachment', response['Content-Disposition'])
+
+    @override_settings(WATERMARK_DOWNLOAD_BACKEND='x-sendfile')
+    def test_x_sendfile(self):
+        response = self.get()
+        self.assertEqual(response['X-Sendfile'], self.watermarked_file.watermarked_file.path)
+        self.assertNotIn('Content-Type', response)
+
+
+def make_zip(members, compression=zipfile.ZIP_DEFLATED):
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', compression) as archive:
+        for name, data in members:
+            archive.writestr(name, data)
+    return SimpleUploadedFile('batch.zip', output.getvalue())
+
+
+class BatchTests(SimpleTestCase):
+    def test_rejects_highly_compressed_members(self):
+        with self.assertRaisesMessage(InvalidBatch, 'compressed more than'):
+            check_uploads([make_zip([('bomb.png', bytes(10 * 1024 * 1024))])])
+
+    @override_settings(WATERMARK_BATCH_MAX_FILES=2)
+    def test_rejects_too_many_members(self):
+        members = [(f'{index}.png', b'x') for index in range(3)]
+        with self.assertRaisesMessage(InvalidBatch, 'at most 2 files'):
+            check_uploads([make_zip(members, zipfile.ZIP_STORED)])
+
+    @override_settings(WATERMARK_BATCH_MAX_BYTES=100)
+    def test_rejects_too_many_bytes_across_uploads(self):
+        files = [make_zip([('a.png', bytes(60))], zipfile.ZIP_STORED), SimpleUploadedFile('b.png', bytes(60))]
+        with self.assertRaisesMessage(InvalidBatch, 'at most 100 bytes'):
+            check_uploads(files)
+
+    def test_rejects_corrupt_archives(self):
+        with self.assertRaises(InvalidBatch):
+            check_uploads([SimpleUploadedFile('broken.zip', b'not a zip')])
+
+    def test_accepted_archive_can_still_be_read(self):
+        upload = make_zip([('dir/', b''), ('dir/a.png', b'data')], zipfile.ZIP_STORED)
+        check_uploads([upload])
+        self.assertEqual(list(iter_uploads([upload])), [('dir/a.png', b'data')])
+
+    def test_safe_name(self):
+        self.assertEqual(safe_name('../../etc/passwd'), 'etc/passwd')
+        self.assertEqual(safe_name('/abs/file.png'), 'abs/file.png')
+        self.assertEqual(safe_name('C:\\dir\\..\\file.png'), 'dir/file.png')
+        self.assertEqual(safe_name('..'), 'file')
+
+    def test_output_names_stay_inside_the_archive(self):
+        results = [
+            ('../../evil.png', (b'a', '.png', None)),
+            ('/abs/evil.png', (b'b', '.png', None)),
+        ]
+        data = b''.join(stream_batch_zip(results))
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            names = archive.namelist()
+        self.assertEqual(names, ['watermarked_evil.png', 'abs/watermarked_evil.png', 'manifest.json'])
+
+    def test_broken_pool_still_ends_the_archive(self):
+        def results():
+            yield 'a.png', (b'a', '.png', None)
+            raise BrokenProcessPool('worker died')
+
+        data = b''.join(stream_batch_zip(results()))
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            manifest = json.loads(archive.read('manifest.json'))
+            self.assertEqual(archive.namelist(), ['watermarked_a.png', 'manifest.json'])
+        self.assertEqual(manifest[-1]['status'], 'error')
+        self.assertIn('worker died', manifest[-1]['error'])
+
+
+class PdfStampTests(MediaTestCase):
+    def stamp(self, pages):
+        output = process_pdf_watermark(ContentFile(make_pdf(pages), name='doc.pdf'), self.template, 0, 0, 0.5, 0)
+        output.seek(0)
+        return PyPDF2.PdfReader(io.BytesIO(output.read()))
+
+    def assertStamped(self, reader, pages):
+        self.assertEqual(len(reader.pages), pages)
+        for page in reader.pages:
+            self.assertTrue(any(name.startswith('/WatermarkStamp') for name in page['/Resources']['/XObject']))
+
+    def test_incremental_update(self):
+        self.assertStamped(self.stamp(3), 3)
+
+    @override_settings(WATERMARK_PDF_PARALLEL_PAGES=5, WATERMARK_PDF_CHUNK_PAGES=4, WATERMARK_PDF_WORKERS=1)
+    def test_page_ranges(self):
+        self.assertStamped(self.stamp(10), 10)
+
+    @override_settings(WATERMARK_PDF_PARALLEL_PAGES=5, WATERMARK_PDF_CHUNK_PAGES=4, WATERMARK_PDF_WORKERS=4)
+    def test_workers_stamp_ranges_without_a_pool(self):
+        with mock.patch('core.pdfstamp.in_worker', return_value=True), \
+                mock.patch('core.pdfstamp.shared_pool') as shared_pool:
+            self.assertStamped(self.stamp(10), 10)
+        shared_pool.assert_not_called()
+
+    def test_only_the_incremental_stamper_writes(self):
+        self.assertTrue(hasattr(IncrementalStamper, 'write'))
+        self.assertFalse(hasattr(RangeStamper, 'write'))
+
+
+def inline_page_pdf():
+    """A one page PDF whose page dictionary sits directly in /Kids."""
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Count 1 /Kids [<< /Type /Page /Parent 2 0 R /MediaBox [0 0 200 300] >>] >>',
+    ]
+    output = io.BytesIO()
+    output.write(b'%PDF-1.4\n')
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(output.tell())
+        output.write(b'%d 0 obj\n%s\nendobj\n' % (number, body))
+    xref = output.tell()
+    output.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    for offset in offsets:
+        output.write(b'%010d 00000 n \n' % offset)
+    output.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref))
+    return output.getvalue()
+
+
+class PreflightTests(SimpleTestCase):
+    def test_reads_the_first_page_of_a_pdf(self):
+        info = preflight(ContentFile(make_pdf(3), name='doc.pdf'))
+        self.assertEqual((info.file_type, info.pages), ('PDF', 3))
+        self.assertEqual([round(side) for side in info.page_size], [595, 842])
+
+    def test_page_trees_without_indirect_pages_are_accepted(self):
+        info = preflight(ContentFile(inline_page_pdf(), name='doc.pdf'))
+        self.assertEqual((info.pages, info.page_size), (1, (200.0, 300.0)))
+
+    def test_unparseable_pdf_is_rejected(self):
+        with self.assertRaises(UnsupportedFile):
+            preflight(ContentFile(b'%PDF-1.4\nnot a document', name='doc.pdf'))
+
+
+def full_layer_text_watermark(img, text, opacity, font_size=36):
+    """The diagonal text pattern drawn the way it was before tiling."""
+    font = get_font(font_size)
+    fill = (255, 255, 255, int(255 * opacity))
+    diagonal_spacing = int(min(img.width, img.height) / 4)
+    txt_layer = Image.new('RGBA', img.size, (255, 255, 255, 0))
+    draw = ImageDraw.Draw(txt_layer)
+    for i in range(-img.height, img.width, diagonal_spacing):
+        draw.text((i, 0), text, font=font, fill=fill)
+    for i in range(-img.height, img.width, diagonal_spacing):
+        draw.text((i, img.height), text, font=font, fill=fill, angle=45)
+    return Image.alpha_composite(img.convert('RGBA'), txt_layer)
+
+
+class TextTilingTests(SimpleTestCase):
+    def check_pixel_identical(self, text, size, mode):
+        template = WatermarkTemplate(name='Text', type='TEXT', text=text)
+        img = Image.radial_gradient('L').resize(size).convert(mode)
+        if mode == 'RGBA':
+            img.putalpha(Image.linear_gradient('L').resize(size).point(lambda value: 255 - value // 2))
+        expected = full_layer_text_watermark(img, text, 0.5)
+        self.assertIsNotNone(ImageChops.difference(expected, img.convert('RGBA')).getbbox(alpha_only=False))
+        for engine in ('full', 'roi'):
+            with self.subTest(text=text, size=size, mode=mode, engine=engine), \
+                    override_settings(WATERMARK_COMPOSITING_ENGINE=engine):
+                result = apply_template_watermark(img.copy(), template, 0.5).convert('RGBA')
+                self.assertIsNone(ImageChops.difference(result, expected).getbbox(alpha_only=False))
+
+    def test_tiles_match_the_full_layer_rendering(self):
+        for size in ((640, 480), (333, 517)):
+            self.check_pixel_identical('TILED', size, 'RGB')
+
+    def test_overlapping_copies_blend_like_draw_text(self):
+        # Copies are wider than the spacing, so neighbours overlap
+        self.check_pixel_identical('CONFIDENTIAL', (200, 160), 'RGB')
+
+    def test_text_wider_than_the_image_is_tall(self):
+        self.check_pixel_identical('A VERY LONG WATERMARK TEXT', (300, 40), 'RGB')
+
+    def test_rgba_base(self):
+        self.check_pixel_identical('TILED', (320, 240), 'RGBA')
+
+
+class CompositingEngineTests(SimpleTestCase):
+    size = (200, 150)
+
+    def make_base(self, mode):
+        img = Image.merge('RGB', [
+            Image.linear_gradient('L').resize(self.size),
+            Image.radial_gradient('L').resize(self.size),
+            Image.linear_gradient('L').rotate(90).resize(self.size),
+        ])
+        if mode == 'RGBA':
+            img.putalpha(Image.radial_gradient('L').resize(self.size).point(lambda value: 255 - value // 2))
+        return img.convert(mode)
+
+    def make_placements(self):
+        overlay = Image.new('RGBA', (60, 40), (250, 40, 90, 0))
+        overlay.putalpha(Image.linear_gradient('L').resize(overlay.size))
+        # Includes placements clipped by every edge; none of them overlap
+        return [(overlay, (-20, -10)), (overlay, (70, 60)), (overlay, (170, 120)), (overlay, (150, -30))]
+
+    def assertSimilar(self, result, expected, tolerance):
+        differences = ImageChops.difference(result, expected).getextrema()
+        if result.mode == 'L':
+            differences = [differences]
+        self.assertLessEqual(max(high for _, high in differences), tolerance)
+
+    def check_engine(self, engine):
+        for mode in ('RGB', 'RGBA', 'L', 'CMYK'):
+            with self.subTest(engine=engine, mode=mode):
+                expected = composite_placements(self.make_base(mode), self.make_placements(), 'full')
+                result = composite_placements(self.make_base(mode), self.make_placements(), engine)
+                self.assertEqual(result.mode, 'RGBA' if mode == 'RGBA' else mode)
+                self.assertNotEqual(result.tobytes(), self.make_base(mode).tobytes())
+                # full always works in RGBA; compare in the image's own mode
+                self.assertSimilar(result, expected.convert(result.mode), 2)
+
+    def test_roi_matches_full(self):
+        self.check_engine('roi')
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_numpy_matches_full(self):
+        self.check_engine('numpy')
+
+    @override_settings(WATERMARK_COMPOSITING_ENGINE='numpy')
+    def test_numpy_falls_back_to_roi(self):
+        with mock.patch('core.compositing.np', None), self.assertLogs('core.compositing', 'WARNING'):
+            self.assertEqual(compositing_engine(), 'roi')
+
+
+class MemoryProbeTests(SimpleTestCase):
+    def test_nested_probe_does_not_reset_the_outer_one(self):
+        with MemoryProbe('outer') as outer:
+            with MemoryProbe('inner') as inner:
+                pass
+        self.assertIsNone(inner.high_water)
+        self.assertIsNotNone(outer.high_water)
+
+    def test_concurrent_probe_is_skipped(self):
+        entered, release = threading.Event(), threading.Event()
+
+        def hold():
+            with MemoryProbe('holder'):
+                entered.set()
+                release.wait()
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        entered.wait()
+        try:
+            with MemoryProbe('other') as probe:
+                pass
+        finally:
+            release.set()
+            holder.join()
+        self.assertIsNone(probe.high_water)
+        with MemoryProbe('after') as probe:
+            pass
+        self.assertIsNotNone(probe.high_water)
+
+    @override_settings(WATERMARK_TRACEMALLOC=True)
+    def test_traced_job_releases_tracemalloc_on_error(self):
+        self.addCleanup(tracemalloc.stop)
+        with self.assertRaises(ValueError):
+            with job('IMAGE', 'TEXT'):
+                raise ValueError('failed')
+        self.assertFalse(_trace_lock.locked())
+
+
+class MetricsTests(MediaTestCase):
+    def test_failed_job_is_observed_with_its_outcome(self):
+        with self.assertRaises(ValueError):
+            with job('IMAGE', 'FAILING'):
+                raise ValueError('failed')
+        series = [labels for metric, labels, *_ in registry.snapshot()
+                  if metric == 'watermark_job_seconds' and ('template_type', 'FAILING') in labels]
+        self.assertEqual(series, [[('file_type', 'IMAGE'), ('outcome', 'error'), ('template_type', 'FAILING')]])
+
+    def test_local_requests_may_read_metrics(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 200)
+
+    @override_settings(WATERMARK_METRICS_ALLOWED_IPS=['10.0.0.0/8'])
+    def test_other_addresses_need_staff(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='10.1.2.3').status_code, 200)
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class JobRetryTests(MediaTestCase):
+    def make_job(self):
+        return WatermarkedFile.objects.create(
+            user=self.user, watermark_template=self.template, file_type='IMAGE',
+            original_file=ContentFile(make_image(0.1, 'PNG'), name='original.png'),
+        )
+
+    def test_deferred_job_is_not_claimed_before_it_is_due(self):
+        watermarked_file = self.make_job()
+        with mock.patch('core.jobs.render_watermarked_file', side_effect=AdmissionBusy('Busy')):
+            run_job(watermarked_file.pk)
+        watermarked_file.refresh_from_db()
+        self.assertEqual((watermarked_file.status, watermarked_file.attempts), ('PENDING', 1))
+        self.assertGreater(watermarked_file.not_before, timezone.now())
+        self.assertEqual(claim_jobs(10), [])
+
+        WatermarkedFile.objects.filter(pk=watermarked_file.pk).update(not_before=timezone.now())
+        self.assertEqual(claim_jobs(10), [watermarked_file.pk])
+
+    @override_settings(WATERMARK_JOB_RETRY_MAX_DELAY=60)
+    def test_delay_doubles_up_to_the_limit(self):
+        exc = AdmissionTimeout('Timeout')
+        self.assertEqual([retry_delay(attempts, exc) for attempts in range(1, 5)], [10, 20, 40, 60])
+
+    def test_enqueue_clears_the_backoff(self):
+        watermarked_file = self.make_job()
+        with mock.patch('core.jobs.render_watermarked_file', side_effect=AdmissionBusy('Busy')):
+            run_job(watermarked_file.pk)
+        watermarked_file.refresh_from_db()
+        with self.settings(WATERMARK_BACKGROUND_JOBS=True):
+            enqueue(watermarked_file)
+        self.assertEqual(claim_jobs(10), [watermarked_file.pk])
+
+
+@override_settings(WATERMARK_LIST_PAGE_SIZE=3)
+class PaginationTests(MediaTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        WatermarkedFile.objects.bulk_create([
+            WatermarkedFile(user=cls.user, watermark_template=cls.template, file_type='IMAGE',
+                            original_file=f'original_files/{number}.png')
+            for number in range(8)
+        ])
+        WatermarkTemplate.objects.bulk_create([
+            WatermarkTemplate(name=f'Text {number}', type='TEXT', text='SAMPLE', user=cls.user)
+            for number in range(5)
+        ])
+        # Rows sharing a created_at straddle page boundaries and are told apart by id
+        now = timezone.now()
+        pks = list(WatermarkedFile.objects.order_by('pk').values_list('pk', flat=True))
+        WatermarkedFile.objects.filter(pk__in=pks[1:6]).update(created_at=now)
+        for minutes, pk in enumerate(pks[:1] + pks[6:], 1):
+            WatermarkedFile.objects.filter(pk=pk).update(created_at=now - timedelta(minutes=minutes))
+        cls.expected = list(WatermarkedFile.objects.order_by('-created_at', '-pk').values_list('pk', flat=True))
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def get_page(self, url_name, cursor=None):
+        response = self.client.get(reverse(url_name), {'cursor': cursor} if cursor else {})
+        self.assertEqual(response.status_code, 200)
+        return response.context
+
+    def test_cursor_page_visits_every_row_once(self):
+        pks, cursor = [], None
+        while True:
+            objects, cursor = cursor_page(WatermarkedFile.objects.all(), cursor, page_size=3)
+            pks += [obj.pk for obj in objects]
+            if cursor is None:
+                break
+        self.assertEqual(pks, self.expected)
+
+    def test_list_view_follows_next_cursor(self):
+        pages, cursor = [], None
+        while True:
+            context = self.get_page('file_list', cursor)
+            pages.append([obj.pk for obj in context['files']])
+            cursor = context['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertEqual(sum(pages, []), self.expected)
+
+    def test_listings_use_a_fixed_number_of_queries(self):
+        # Session, user and the page itself, however many rows are shown
+        for url_name in ('file_list', 'template_list'):
+            with self.subTest(url_name=url_name), self.assertNumQueries(3):
+                cursor = self.get_page(url_name)['next_cursor']
+            with self.subTest(url_name=url_name, cursor=cursor), self.assertNumQueries(3):
+                self.get_page(url_name, cursor)
+
+
+class ContentAddressedStorageTests(MediaTestCase):
+    data = make_image(0.1, 'PNG')
+
+    def make_file(self, name='original.png'):
+        watermarked_file = WatermarkedFile.objects.create(
+            user=self.user, watermark_template=self.template, file_type='IMAGE',
+            original_file=ContentFile(self.data, name=name),
+        )
+        enqueue(watermarked_file)
+        watermarked_file.refresh_from_db()
+        return watermarked_file
+
+    def test_identical_uploads_are_stored_once(self):
+        first, second = self.make_file('photo.PNG'), self.make_file('copy.png')
+        digest = hashlib.sha256(self.data).hexdigest()
+        self.assertEqual(first.content_hash, digest)
+        self.assertEqual(first.original_file.name, f'original_files/{digest[:2]}/{digest}.png')
+        self.assertEqual(second.original_file.name, first.original_file.name)
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'original_files', digest[:2])), [f'{digest}.png'])
+
+    def test_identical_job_reuses_the_output(self):
+        first = self.make_file()
+        with mock.patch('core.views.process_image_watermark') as process_image_watermark:
+            second = self.make_file()
+        process_image_watermark.assert_not_called()
+        self.assertEqual(second.status, 'DONE')
+        self.assertEqual(second.render_key, first.render_key)
+        self.assertEqual(second.watermarked_file.name, first.watermarked_file.name)
+
+    @override_settings(WATERMARK_RENDER_MODE='lazy')
+    def test_evicting_a_shared_output_rerenders_for_every_row(self):
+        first, second = self.make_file(), self.make_file()
+        self.assertTrue(ensure_rendered(first))
+        self.assertTrue(ensure_rendered(second))
+        second.refresh_from_db()
+        self.assertEqual(second.watermarked_file.name, first.watermarked_file.name)
+
+        evict_results(max_bytes=0)
+
+        for watermarked_file in (first, second):
+            watermarked_file.refresh_from_db()
+            self.assertEqual((watermarked_file.status, watermarked_file.watermarked_file.name), ('RECIPE', ''))
+            self.assertTrue(ensure_rendered(watermarked_file))
+            self.assertTrue(watermarked_file.watermarked_file.storage.exists(watermarked_file.watermarked_file.name))
+
+
+@override_settings(WATERMARK_RENDER_MODE='lazy')
+class ResultCacheTests(MediaTestCase):
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def make_recipe(self, opacity):
+        watermarked_file = WatermarkedFile.objects.create(
+            user=self.user, watermark_template=self.template, file_type='IMAGE', opacity=opacity,
+            original_file=ContentFile(make_image(0.1, 'PNG'), name='original.png'),
+        )
+        enqueue(watermarked_file)
+        return watermarked_file
+
+    def download(self, watermarked_file):
+        response = self.client.get(reverse('download_watermarked_file', args=[watermarked_file.pk]))
+        self.assertEqual(response.status_code, 200)
+        b''.join(response.streaming_content)
+        watermarked_file.refresh_from_db()
+        return watermarked_file
+
+    def test_renders_on_first_download(self):
+        watermarked_file = self.make_recipe(0.5)
+        self.assertEqual(watermarked_file.status, 'RECIPE')
+        self.assertFalse(watermarked_file.watermarked_file)
+
+        watermarked_file = self.download(watermarked_file)
+
+        self.assertEqual(watermarked_file.status, 'DONE')
+        self.assertEqual(watermarked_file.output_size, watermarked_file.watermarked_file.size)
+
+    def test_evicts_least_recently_downloaded_first(self):
+        first, second, third = (self.download(self.make_recipe(opacity)) for opacity in (0.2, 0.4, 0.6))
+        self.download(first)
+        budget = first.output_size + third.output_size
+
+        self.assertEqual(evict_results(max_bytes=budget), 1)
+
+        states = {item.pk: item.status for item in WatermarkedFile.objects.all()}
+        self.assertEqual(states, {first.pk: 'DONE', second.pk: 'RECIPE', third.pk: 'DONE'})
+        self.assertFalse(second.watermarked_file.storage.exists(second.watermarked_file.name))
+
+    def test_rerenders_after_eviction(self):
+        watermarked_file = self.download(self.make_recipe(0.5))
+        evict_results(max_bytes=0)
+        watermarked_file.refresh_from_db()
+        self.assertEqual(watermarked_file.status, 'RECIPE')
+
+        watermarked_file = self.download(watermarked_file)
+
+        self.assertEqual(watermarked_file.status, 'DONE')
+        self.assertTrue(watermarked_file.watermarked_file.storage.exists(watermarked_file.watermarked_file.name))
+
+    @override_settings(WATERMARK_RESULT_CACHE_BYTES=1)
+    def test_download_keeps_a_shared_output(self):
+        rendered, sharing = self.make_recipe(0.5), self.make_recipe(0.5)
+        rendered = self.download(rendered)
+
+        sharing = self.download(sharing)
+
+        self.assertEqual(sharing.watermarked_file.name, rendered.watermarked_file.name)
+        self.assertTrue(sharing.watermarked_file.storage.exists(sharing.watermarked_file.name))
+
+
+class DerivativeTests(MediaTestCase):
+    sizes = {'thumb': 64, 'medium': 200, 'huge': 4000}
+
+    def process(self, image_format='PNG', output_options=None):
+        original = ContentFile(make_image(0.1, image_format), name=f'original.{image_format.lower()}')
+        # Preflight only reads the header, so the one decoder is the full decode
+        with mock.patch.object(Image, '_getdecoder', wraps=Image._getdecoder) as getdecoder:
+            processed = process_image_watermark(original, self.template, 0, 0, 0.5, 0, output_options=output_options,
+                                                derivatives=self.sizes)
+        self.assertEqual(getdecoder.call_count, 1)
+        return processed
+
+    def test_variants_come_from_the_single_decode(self):
+        processed = self.process()
+        # Sizes at least as large as the output are covered by the output itself
+        self.assertEqual(sorted(processed.derivatives), ['medium', 'thumb'])
+
+    def test_longest_side_and_aspect_ratio(self):
+        processed = self.process()
+        with Image.open(processed) as output:
+            width, height = output.size
+        for name, derivative in processed.derivatives.items():
+            with self.subTest(name=name), Image.open(derivative) as variant:
+                self.assertEqual(variant.size, (derivative.width, derivative.height))
+                self.assertEqual(max(variant.size), self.sizes[name])
+                self.assertAlmostEqual(variant.width / variant.height, width / height, delta=0.02)
+
+    def test_encoded_like_the_output(self):
+        for image_format, output_options, expected in (
+                ('JPEG', None, ('JPEG', '.jpg')),
+                ('PNG', dict(DEFAULT_OPTIONS, format='WEBP'), ('WEBP', '.webp'))):
+            processed = self.process(image_format, output_options)
+            for name, derivative in processed.derivatives.items():
+                with self.subTest(image_format=image_format, name=name), Image.open(derivative) as variant:
+                    self.assertEqual((variant.format, os.path.splitext(derivative.name)[1]), expected)
+                    self.assertTrue(processed.name.endswith(expected[1]))
+
+    @override_settings(WATERMARK_DERIVATIVES={'thumb': 64})
+    def test_job_stores_the_variants(self):
+        watermarked_file = WatermarkedFile.objects.create(
+            user=self.user, watermark_template=self.template, file_type='IMAGE',
+            original_file=ContentFile(make_image(0.1, 'PNG'), name='original.png'),
+        )
+        enqueue(watermarked_file)
+        watermarked_file.refresh_from_db()
+        thumb = watermarked_file.derivatives['thumb']
+        self.assertEqual(max(thumb['width'], thumb['height']), 64)
+        self.assertTrue(watermarked_file.watermarked_file.storage.exists(thumb['name']))
+
+
+class RecipeOptionsTests(MediaTestCase):
+    def test_upload_resolves_the_encoder_options_once(self):
+        WatermarkSettings.objects.create(user=self.user, output_format='WEBP', webp_quality=70)
+        self.client.force_login(self.user)
+
+        response = self.client.post(reverse('api:file-list'), {
+            'original_file': ContentFile(make_image(0.1, 'PNG'), name='photo.png'),
+            'watermark_template': self.template.pk, 'file_type': 'IMAGE',
+        })
+
+        self.assertEqual(response.status_code, 201)
+        watermarked_file = WatermarkedFile.objects.get()
+        self.assertEqual(watermarked_file.output_options['format'], 'WEBP')
+        self.assertEqual(watermarked_file.output_options['webp_quality'], 70)
+        self.assertTrue(watermarked_file.watermarked_file.name.endswith('.webp'))
+
+    def test_save_does_not_query_the_settings(self):
+        watermarked_file = self.make_output(b'data')
+        watermarked_file.status = 'FAILED'
+        with self.assertNumQueries(1):
+            watermarked_file.save(update_fields=['status'])
+
+
+class OverlayCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def overlay(self):
+        return Image.radial_gradient('L').resize((64, 64)).convert('RGBA')
+
+    def cached_files(self):
+        return sorted(os.path.relpath(os.path.join(root, name), self.directory)
+                      for root, _, names in os.walk(self.directory) for name in names)
+
+    def test_disk_tier_drops_the_least_recently_used_files(self):
+        cache = OverlayCache(max_bytes=0)
+        with override_settings(WATERMARK_OVERLAY_CACHE_DIR=self.directory, WATERMARK_OVERLAY_CACHE_DIR_BYTES=None):
+            for number in range(3):
+                cache.get_or_render((1, number), self.overlay)
+            paths = {number: cache._path((1, number)) for number in range(3)}
+        file_size = os.path.getsize(paths[0])
+        for age, number in enumerate((1, 0, 2)):
+            os.utime(paths[number], (1000 + age, 1000 + age))
+
+        with override_settings(WATERMARK_OVERLAY_CACHE_DIR=self.directory,
+                               WATERMARK_OVERLAY_CACHE_DIR_BYTES=3 * file_size):
+            # A disk hit marks the file as used
+            cache.get_or_render((1, 1), lambda: self.fail('should be read from disk'))
+            cache.get_or_render((1, 3), self.overlay)
+
+        self.assertEqual(cache.stats()['disk_hits'], 1)
+        self.assertFalse(os.path.exists(paths[0]))
+        self.assertEqual(len(self.cached_files()), 3)
+        self.assertTrue(os.path.exists(paths[1]))
+
+    def test_default_directory_is_outside_the_source_tree(self):
+        from django.conf import settings
+
+        directory = os.path.abspath(settings.WATERMARK_OVERLAY_CACHE_DIR)
+        self.assertFalse(directory.startswith(str(settings.BASE_DIR) + os.sep))
+
+
+class StampCacheTests(MediaTestCase):
+    def stamp(self, text):
+        return render_stamp(200, 200, lambda c: c.drawString(10, 10, text))
+
+    def test_bounded_by_bytes(self):
+        cost = StampCache._cost(self.stamp('AAAA'))
+        cache = StampCache(max_bytes=2 * cost)
+        for text in ('AAAA', 'BBBB', 'CCCC'):
+            cache.get_or_render(text, lambda: self.stamp(text))
+        self.assertEqual(cache.stats()['size'], 2)
+        self.assertLessEqual(cache.stats()['bytes'], 2 * cost)
+
+        cache.get_or_render('AAAA', lambda: self.stamp('AAAA'))
+        self.assertEqual(cache.stats()['misses'], 4)
+
+    def test_oversized_stamps_are_not_kept(self):
+        cache = StampCache(max_bytes=1)
+        cache.get_or_render('AAAA', lambda: self.stamp('AAAA'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_image_templates_are_keyed_by_content(self):
+        def image(color):
+            output = io.BytesIO()
+            Image.new('RGBA', (32, 32), color).save(output, format='PNG')
+            return ContentFile(output.getvalue(), name='logo.png')
+
+        template = WatermarkTemplate.objects.create(name='Logo', type='IMAGE', image=image('red'), user=self.user)
+        same = WatermarkTemplate.objects.get(pk=template.pk)
+        self.assertEqual(template_digest(same), template_digest(template))
+
+        # Replace the file in place, keeping the name and the row untouched
+        with open(template.image.path, 'wb') as fh:
+            fh.write(image('blue').read())
+        changed = WatermarkTemplate.objects.get(pk=template.pk)
+        self.assertNotEqual(template_digest(changed), template_digest(template))
+        self.assertIsNot(get_template_stamp(changed, 200, 200, 0.5, 0), get_template_stamp(template, 200, 200, 0.5, 0))
+
+
+class BenchWatermarkTests(MediaTestCase):
+    def test_reports_the_high_water_delta(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, 'bench.json')
+
+        call_command('bench_watermark', paths=['image'], megapixels=[0.05], image_formats=['PNG'],
+                     templates=['text'], repeat=1, json_output=path, stdout=io.StringIO())
+
+        with open(path) as fh:
+            result, = json.load(fh)
+        self.assertIn('high_water_delta', result)
+        self.assertNotIn('peak_rss', result)
@@ -0,0 +1,144 @@
+import hashlib
+import os
+import tempfile
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.utils import timezone
+
+CHUNK_SIZE = 1024 * 1024
+
+# SHA-256 state of sessions this process wrote the latest chunk of, as
+# {session id: (offset, hasher)}. hashlib objects cannot be stored, so a
+# session resumed in another process re-hashes its part file once.
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+
+class OffsetMismatch(Exception):
+    """A chunk did not start where the session's data ends."""
+
+    def __init__(self, offset):
+        super().__init__(f'Expected a chunk starting at byte {offset}')
+        self.offset = offset
+
+
+def upload_dir():
+    return (getattr(settings, 'WATERMARK_UPLOAD_DIR', None)
+            or settings.FILE_UPLOAD_TEMP_DIR or tempfile.gettempdir())
+
+
+def max_upload_size():
+    return getattr(settings, 'WATERMARK_UPLOAD_MAX_SIZE', 10 * 1024 * 1024 * 1024)
+
+
+def part_path(session):
+    return os.path.join(upload_dir(), f'watermark-upload-{session.pk.hex}.part')
+
+
+def _hasher_at(session, path):
+    with _hashers_lock:
+        entry = _hashers.pop(session.pk, None)
+    if entry is not None and entry[0] == session.offset:
+        return entry[1]
+    hasher = hashlib.sha256()
+    if session.offset:
+        with open(path, 'rb') as fh:
+            remaining = session.offset
+            while remaining:
+                data = fh.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    raise OSError(f'Upload data for session {session.pk} is missing')
+                hasher.update(data)
+                remaining -= len(data)
+    return hasher
+
+
+def write_chunk(session, start, stream, length):
+    """Write ``length`` bytes read from ``stream`` at byte ``start`` of the upload.
+
+    Chunks go straight into the part file and the digest, so nothing is
+    buffered in memory or re-read later. If the stream ends early the bytes
+    that did arrive are kept and ``session.offset`` says where to resume.
+    The caller holds a lock on the session row and saves it afterwards.
+    """
+    if start != session.offset:
+        raise OffsetMismatch(session.offset)
+    if start + length > session.size:
+        raise ValueError('Chunk extends past the declared upload size')
+
+    path = part_path(session)
+    hasher = _hasher_at(session, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as fh:
+        # Drop anything a failed request left after the acknowledged offset
+        fh.truncate(start)
+        fh.seek(start)
+        remaining = length
+        while remaining:
+            data = stream.read(min(CHUNK_SIZE, remaining)) if stream is not None else b''
+            if not data:
+                break
+            fh.write(data)
+            hasher.update(data)
+            remaining -= len(data)
+
+    session.offset = start + length - remaining
+    with _hashers_lock:
+        _hashers[session.pk] = (session.offset, hasher)
+    return session.offset
+
+
+class CompletedUpload(File):
+    """The assembled file of a finished session.
+
+    It exposes temporary_file_path() like Django's TemporaryUploadedFile, so
+    FileSystemStorage moves the part file into place instead of copying it,
+    and carries ``content_hash`` for store_content_addressed().
+    """
+
+    def __init__(self, session, content_hash):
+        self._path = part_path(session)
+        super().__init__(open(self._path, 'rb'), name=session.filename)
+        self.size = session.size
+        self.content_hash = content_hash
+
+    def temporary_file_path(self):
+        return self._path
+
+
+def complete_upload(session):
+    """Return a CompletedUpload once every byte of ``session`` has arrived."""
+    if session.offset != session.size:
+        raise OffsetMismatch(session.offset)
+    hasher = _hasher_at(session, part_path(session))
+    if not os.path.exists(part_path(session)):
+        # An empty upload never had a chunk written
+        open(part_path(session), 'wb').close()
+    return CompletedUpload(session, hasher.hexdigest())
+
+
+def discard_upload(session):
+    with _hashers_lock:
+        _hashers.pop(session.pk, None)
+    try:
+        os.remove(part_path(session))
+    except FileNotFoundError:
+        pass
+
+
+def purge_stale_sessions(max_age=None):
+    """Delete sessions with no activity for WATERMARK_UPLOAD_SESSION_TTL seconds."""
+    from .models import UploadSession
+
+    if max_age is None:
+        max_age = getattr(settings, 'WATERMARK_UPLOAD_SESSION_TTL', 24 * 60 * 60)
+    stale = UploadSession.objects.filter(updated_at__lt=timezone.now() - timedelta(seconds=max_age))
+    count = 0
+    for session in stale.iterator():
+        discard_upload(session)
+        session.delete()
+        count += 1
+    return count
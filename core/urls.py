@@ -14,7 +14,11 @@ urlpatterns = [
     path('files/', views.WatermarkedFileListView.as_view(), name='file_list'),
 
     path('watermarked-file/<int:pk>/', views.watermarked_file_detail, name='watermarked_file_detail'),
+    path('watermarked-file/<int:pk>/download/', views.download_watermarked_file, name='download_watermarked_file'),
 
     # Settings
     path('settings/', views.settings_view, name='settings'),
+
+    # Prometheus metrics
+    path('metrics/', views.metrics, name='metrics'),
 ]
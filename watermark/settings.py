@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -37,10 +38,13 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'rest_framework',
     'core',
+    'api',
 ]
 
 MIDDLEWARE = [
+    'core.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -122,3 +126,107 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Watermarking
+
+# Memory budget for pre-rendered PDF watermark overlays, in bytes
+WATERMARK_STAMP_CACHE_BYTES = 64 * 1024 * 1024
+
+# Render watermarks in the run_watermark_worker process pool instead of the request
+WATERMARK_BACKGROUND_JOBS = True
+# Worker processes per run_watermark_worker (None uses the CPU count)
+WATERMARK_WORKERS = None
+WATERMARK_WORKER_POLL_INTERVAL = 1.0
+# Jobs deferred for lack of memory are retried after their Retry-After delay,
+# doubled on each consecutive deferral up to this many seconds
+WATERMARK_JOB_RETRY_MAX_DELAY = 300
+# Processes used by the batch API (None uses the CPU count)
+WATERMARK_BATCH_WORKERS = None
+# Batch API limits, checked before any ZIP member is decompressed: number of
+# files, size of one file and of the whole batch in bytes (uncompressed), and
+# the highest compression ratio accepted for a ZIP member
+WATERMARK_BATCH_MAX_FILES = 1000
+WATERMARK_BATCH_MAX_FILE_SIZE = 256 * 1024 * 1024
+WATERMARK_BATCH_MAX_BYTES = 1024 * 1024 * 1024
+WATERMARK_BATCH_MAX_RATIO = 100
+# Memory budget for rendered text watermark sprites, in bytes
+WATERMARK_TEXT_SPRITE_CACHE_BYTES = 32 * 1024 * 1024
+# Rendered PDFs are kept in memory up to this size, then spill to a temporary file
+WATERMARK_SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+# Hash uploads while they stream in so originals can be stored by content
+FILE_UPLOAD_HANDLERS = [
+    'core.storage.HashingMemoryFileUploadHandler',
+    'core.storage.HashingTemporaryFileUploadHandler',
+]
+# How image watermarks are blended: 'full' (full-size layer), 'roi' (only the
+# covered regions, Pillow) or 'numpy' (covered regions, vectorised; needs the
+# optional numpy from requirements.txt, without it 'roi' is used with a warning)
+WATERMARK_COMPOSITING_ENGINE = 'roi'
+# Longest side of image previews and how long previews stay cached, in seconds
+WATERMARK_PREVIEW_MAX_SIZE = 1024
+WATERMARK_PREVIEW_CACHE_TIMEOUT = 600
+# Most PDF pages rendered by a single preview request
+WATERMARK_PREVIEW_MAX_PAGES = 10
+# Record the peak Python heap of every watermarking job with tracemalloc (slow)
+WATERMARK_TRACEMALLOC = False
+# Directory where each process shares its metrics for the /metrics/ endpoint
+# (None keeps them per process)
+WATERMARK_METRICS_DIR = None
+# Addresses or networks allowed to read /metrics/ besides staff users; behind a
+# reverse proxy REMOTE_ADDR is the proxy, so only route /metrics/ internally
+WATERMARK_METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+# How watermarked PDFs are written: 'incremental' appends an update to the
+# untouched original bytes, 'rewrite' re-serialises the whole document
+WATERMARK_PDF_WRITE_MODE = 'incremental'
+# PDFs with at least this many pages are stamped in page ranges across one
+# shared process pool (None workers uses the CPU count); job and batch worker
+# processes stamp their ranges serially
+WATERMARK_PDF_PARALLEL_PAGES = 500
+WATERMARK_PDF_CHUNK_PAGES = 100
+WATERMARK_PDF_WORKERS = None
+# Prepared IMAGE template overlays: in-process memory budget in bytes, the
+# directory of the on-disk tier shared by the processes of a host (None keeps
+# them in memory only) and its size limit in bytes (None: no limit)
+WATERMARK_OVERLAY_CACHE_BYTES = 64 * 1024 * 1024
+WATERMARK_OVERLAY_CACHE_DIR = Path(tempfile.gettempdir()) / 'watermark-overlays'
+WATERMARK_OVERLAY_CACHE_DIR_BYTES = 256 * 1024 * 1024
+# Target image sizes whose overlays are prepared when an IMAGE template is created
+WATERMARK_OVERLAY_WARM_SIZES = []
+# Rows per page of the file and template listings (HTML and API)
+WATERMARK_LIST_PAGE_SIZE = 20
+# Chunked upload API: where part files are assembled (None uses FILE_UPLOAD_TEMP_DIR
+# or the system temp dir; keep it on the media filesystem so finishing is a rename),
+# the largest accepted upload in bytes, and how long idle sessions are kept, in seconds
+WATERMARK_UPLOAD_DIR = None
+WATERMARK_UPLOAD_MAX_SIZE = 10 * 1024 * 1024 * 1024
+WATERMARK_UPLOAD_SESSION_TTL = 24 * 60 * 60
+# 'eager' renders every upload; 'lazy' stores only the recipe and renders on first
+# download, keeping those outputs within WATERMARK_RESULT_CACHE_BYTES (None: no limit)
+WATERMARK_RENDER_MODE = 'eager'
+WATERMARK_RESULT_CACHE_BYTES = None
+# Hand downloads to the front-end server: None (Django streams the file),
+# 'x-accel-redirect' (nginx, internal location WATERMARK_X_ACCEL_PREFIX mapped
+# to the media root) or 'x-sendfile' (Apache mod_xsendfile, lighttpd)
+WATERMARK_DOWNLOAD_BACKEND = None
+WATERMARK_X_ACCEL_PREFIX = '/protected-media/'
+# Threads the async upload views decode and render in; caps CPU work per ASGI
+# worker however many uploads are in flight (None uses the CPU count)
+WATERMARK_ASYNC_RENDER_WORKERS = None
+# Admission control: largest image accepted (Pillow decompression-bomb limit),
+# optional PDF page limit, and memory budgets in bytes for jobs in one process
+# and across all processes on the host (None disables a budget). Jobs wait up
+# to WATERMARK_ADMISSION_TIMEOUT seconds for memory, with at most
+# WATERMARK_ADMISSION_MAX_WAITING waiting per process
+WATERMARK_MAX_IMAGE_PIXELS = 178956970
+WATERMARK_MAX_PDF_PAGES = None
+WATERMARK_MEMORY_BUDGET = 2 * 1024 * 1024 * 1024
+WATERMARK_HOST_MEMORY_BUDGET = None
+WATERMARK_ADMISSION_DIR = None
+WATERMARK_ADMISSION_TIMEOUT = 30
+WATERMARK_ADMISSION_MAX_WAITING = 32
+# Sized variants emitted with every image output from the same decode and
+# composite, as name -> longest side in pixels, e.g. {'thumbnail': 256, 'web': 1080};
+# the main output is the full-size one
+WATERMARK_DERIVATIVES = {}